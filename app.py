@@ -1,15 +1,97 @@
-from yaml import safe_load
+import os
+import sys
+import types
 
-from src.interpreter.interpreter import Interpreter
-from src.logger import Logger
+from src.client import DEFAULT_SOCKET
+from src.startup import StartupProfile
+
+
+DEFAULTS = {'config': 'config.yaml', 'batch': None, 'stop_on_error': False, 'profile_startup': False,
+            'startup_budget': None, 'daemon': False, 'socket': DEFAULT_SOCKET}
+
+
+def parse_args(argv):
+    # plain invocations and commands sent to the daemon do not pay for importing argparse
+    if not argv or not argv[0].startswith('-'):
+        return types.SimpleNamespace(**DEFAULTS, command=argv)
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Telecloud CLI")
+    parser.add_argument('-c', '--config', help='Path to the configuration file.')
+    parser.add_argument('-b', '--batch', metavar='SCRIPT', help='Run the commands of SCRIPT (- for stdin) and exit.')
+    parser.add_argument('-e', '--stop-on-error', action='store_true', help='Stop the batch at the first failing command.')
+    parser.add_argument('--profile-startup', action='store_true', help='Print a startup time report and exit.')
+    parser.add_argument('--startup-budget', type=float, help='Print a startup time report and exit with status 1 if startup took longer than this many milliseconds.')
+    parser.add_argument('--daemon', action='store_true', help='Keep the session loaded and serve commands on the socket.')
+    parser.add_argument('-s', '--socket', help='Unix socket of the daemon.')
+    parser.add_argument('command', nargs=argparse.REMAINDER, help='Command to run and exit, through the daemon when it is running.')
+    parser.set_defaults(**DEFAULTS)
+    return parser.parse_args(argv)
 
 
 if __name__ == "__main__":
-    with open('config.yaml', 'r') as f:
-        config = safe_load(f)
+    profile = StartupProfile()
+
+    with profile.phase('arguments'):
+        args = parse_args(sys.argv[1:])
+
+    # stdin belongs to this process, commands reading it are not sent to the daemon
+    if args.command and '-' not in args.command and not args.daemon and os.path.exists(args.socket):
+        from src.client import run_command
+        try:
+            sys.exit(run_command(args.socket, ' '.join(args.command)))
+        except (ConnectionRefusedError, FileNotFoundError):  # stale socket of a daemon that is gone, run the command here
+            pass
+        except PermissionError as e:
+            print(f"Not using the daemon socket: {e}", file=sys.stderr)
+
+    with profile.phase('imports'):
+        from yaml import safe_load
+
+        from src.interpreter.interpreter import Interpreter
+        from src.logger import Logger
+
+    with profile.phase('config'):
+        with open(args.config, 'r') as f:
+            config = safe_load(f)
+
+        api_url = config['api_url']
+        download_cache = config.get('download_cache')
+        bandwidth = config.get('bandwidth')
+
+    with profile.phase('logger'):
+        logger = Logger()
+
+    with profile.phase('interpreter'):
+        interpreter = Interpreter(api_url, download_cache=download_cache, bandwidth=bandwidth)
+
+    if args.profile_startup or args.startup_budget is not None:
+        profile.report()
+        if args.startup_budget is not None and profile.elapsed > args.startup_budget:
+            print(f"Startup took {profile.elapsed:.1f} ms, budget is {args.startup_budget:.1f} ms", file=sys.stderr)
+            sys.exit(1)
+        sys.exit(0)
+
+    if args.daemon:
+        from src.daemon import Daemon
+        interpreter.remote_filesystem.wait_until_loaded()
+        interpreter.remote_filesystem.subscribe()
+        try:
+            Daemon(interpreter, args.socket).serve_forever()
+        except RuntimeError as e:
+            print(e, file=sys.stderr)
+            sys.exit(1)
+        sys.exit(0)
+
+    if args.command:
+        sys.exit(interpreter.run_batch([' '.join(args.command)]))
 
-    api_url = config['api_url']
-    logger = Logger()
+    if args.batch:
+        if args.batch == '-':
+            sys.exit(interpreter.run_batch(sys.stdin, args.stop_on_error))
+        with open(args.batch, 'r') as f:
+            sys.exit(interpreter.run_batch(f, args.stop_on_error))
 
-    interpreter = Interpreter(api_url)
+    interpreter.remote_filesystem.subscribe()
     interpreter.run()
@@ -1,134 +1,395 @@
-import requests
-import mimetypes
+import itertools
 import os
-from tqdm import tqdm
+import stat
+import threading
+import uuid
+from contextlib import contextmanager
+from urllib.parse import urlencode
 
+from src import compression
+from src.concurrency import bounded_chain, AdaptiveLimit, TokenBucket
+from src.integrity import HashingReader
+from src.jobs import in_background
+from src.lazy import LazyModule
+
+requests = LazyModule('requests')
+mimetypes = LazyModule('mimetypes')
+tqdm = LazyModule('tqdm')
+
+
+
+def slice_chunks(chunks, start=0, end=None):
+    # bytes [start, end) of a stream of chunks, a negative start counts from the end of the stream
+    if start < 0:
+        tail = b''
+        for chunk in chunks:
+            tail = (tail + chunk)[start:]
+        yield tail
+        return
+
+    position = 0
+    for chunk in chunks:
+        chunk_start, position = position, position + len(chunk)
+        if position <= start:
+            continue
+        chunk = chunk[max(start - chunk_start, 0):]
+        if end is not None and position >= end:
+            yield chunk[:len(chunk) - (position - end)]
+            return
+        yield chunk
+
+
+class MultipartBody:
+
+    # multipart/form-data body streamed from the file, as encoded by requests but without reading the file in memory
+    def __init__(self, fields, name, file, filename, size=None, chunk_size=64 * 1024, throttle=None):
+        boundary = uuid.uuid4().hex
+        self.content_type = f'multipart/form-data; boundary={boundary}'
+        self._file = file
+        self._chunk_size = chunk_size
+        self._throttle = throttle
+
+        head = b''
+        for field, value in fields:
+            head += f'--{boundary}\r\nContent-Disposition: form-data; name="{field}"\r\n\r\n{value}\r\n'.encode()
+        head += f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n\r\n'.encode()
+        self._head = head
+        self._tail = f'\r\n--{boundary}--\r\n'.encode()
+        self.length = len(head) + size + len(self._tail) if size is not None else None
+
+    def __iter__(self):
+        yield self._head
+        for chunk in iter(lambda: self._file.read(self._chunk_size), b''):
+            if self._throttle:
+                self._throttle.consume(len(chunk))
+            yield chunk
+        yield self._tail
+
+    def stream(self):
+        # a sized body is sent with a Content-Length, one of unknown size with chunked transfer encoding
+        return self if self.length is not None else iter(self)
+
+    def __len__(self):
+        return self.length
 
 
 class Api:
 
-    def __init__(self, api_url):
+    directory_batch_size = 100
+    workers = 8
+
+    def __init__(self, api_url, check_connection=True, bandwidth=None):
         self.api_url = api_url
+        self._session = None
+        self._bulk_session = None
+        self._feed_session = None
 
-        try:
-            self.test_connection()
-        except requests.exceptions.ConnectionError:
-            raise ConnectionError("Connection to the server could not be established")
+        # optional caps in bytes per second of the interactive (metadata) and bulk (file contents) lanes
+        bandwidth = bandwidth or {}
+        self._throttles = {lane: TokenBucket(rate) if rate else None
+                           for lane, rate in (('interactive', bandwidth.get('interactive')), ('bulk', bandwidth.get('bulk')))}
+
+        # concurrency of the bulk paths of each lane, adapted to the latency and errors of its responses
+        self.concurrency = {'interactive': AdaptiveLimit(initial=self.workers), 'bulk': AdaptiveLimit(initial=2, maximum=16)}
+        self._progress_lines = set()
+        self._progress_lock = threading.Lock()
+
+        if check_connection:
+            try:
+                self.test_connection()
+            except requests.exceptions.ConnectionError:
+                raise ConnectionError("Connection to the server could not be established")
+
+    @property
+    def session(self):
+        # interactive lane: small metadata requests, never queued behind file contents
+        if self._session is None:
+            self._session = self._new_session('interactive')
+        return self._session
+
+    @property
+    def bulk_session(self):
+        # bulk lane: uploads, downloads and reads of file contents
+        if self._bulk_session is None:
+            self._bulk_session = self._new_session('bulk')
+        return self._bulk_session
+
+    @property
+    def feed_session(self):
+        # long polls of the change feed, kept apart so their latency does not shrink the interactive limit
+        if self._feed_session is None:
+            self._feed_session = requests.Session()
+        return self._feed_session
+
+    def _new_session(self, lane):
+        session = requests.Session()
+        limit = self.concurrency[lane]
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=limit.maximum)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.hooks['response'].append(lambda response, *args, **kwargs: limit.record(
+            response.elapsed.total_seconds(), response.status_code != 429 and response.status_code < 500))
+
+        throttle = self._throttles[lane]
+        if throttle and lane == 'interactive':
+            session.hooks['response'].append(lambda response, *args, **kwargs: throttle.consume(len(response.content or b'')))
+        return session
 
     def test_connection(self):
-        response = requests.get(f"{self.api_url}")
+        response = self.session.get(f"{self.api_url}")
         return response.status_code == 200
 
     def get_remote_folder_structure(self):
-        response = requests.get(f"{self.api_url}/structure/directories")
+        response = self.session.get(f"{self.api_url}/structure/directories")
         return response.json()
 
     def get_remote_files_structure(self):
-        response = requests.get(f"{self.api_url}/structure/files")
+        response = self.session.get(f"{self.api_url}/structure/files")
         return response.json()
 
+    def get_changes(self, since=None, wait=0):
+        # change feed of the structure: {"version": v, "changes": [{"op": "add" | "remove" | "move" | "update", "id": ...,
+        # "path": ..., "is_dir": ...}]} since a version, only the current version without one. With wait, the server
+        # holds the request until there are changes or the wait is over. None when the server has no change feed,
+        # changes are None when the version is too old to be replayed, other errors raise and are worth retrying
+        url = self._format_url(f"{self.api_url}/structure/changes", {"since": None if since is None else str(since), "wait": wait})
+        session = self.feed_session if wait else self.session
+        res = session.get(url, timeout=wait + 30 if wait else None)
+        if res.status_code in (404, 501):
+            return None
+        if res.status_code == 410:
+            return {"version": None, "changes": None}
+        res.raise_for_status()
+        try:
+            feed = res.json()
+        except ValueError:
+            return None
+        return feed if isinstance(feed, dict) and 'version' in feed else None
+
     def get_files_meta(self, tags, directories):
         query = {"tags": tags, "directories": directories}
         url = self._format_url(f"{self.api_url}/files/meta", query)
-        res = requests.get(url)
+        res = self.session.get(url)
         files = res.json() if res.status_code == 200 else []
         return files
 
+    def iter_files_meta(self, tags, directories, page_size=1000):
+        if not directories or len(directories) <= self.directory_batch_size:
+            pages = self._iter_files_meta_pages(tags, directories, page_size)
+        else:
+            # the batches are listed concurrently, their pages are handed over as they arrive
+            batches = [directories[i:i + self.directory_batch_size] for i in range(0, len(directories), self.directory_batch_size)]
+            pages = bounded_chain(lambda batch: self._iter_files_meta_pages(tags, batch, page_size), batches, self.concurrency['interactive'])
+
+        for files in pages:
+            yield from files
+
+    def _iter_files_meta_pages(self, tags, directories, page_size):
+        query = {"tags": tags, "directories": directories, "limit": page_size}
+        skip = 0
+        first_id = None
+        while True:
+            url = self._format_url(f"{self.api_url}/files/meta", {**query, "skip": skip})
+            res = self.session.get(url)
+            files = res.json() if res.status_code == 200 else []
+
+            if skip and files and files[0]['_id'] == first_id:  # pagination is ignored by the server
+                return
+            first_id = first_id or (files[0]['_id'] if files else None)
+
+            yield files
+            if len(files) != page_size:  # last page, or the whole listing when pagination is ignored
+                return
+            skip += page_size
+
     def get_directories(self):
-        res = requests.get(f"{self.api_url}/directories/meta")
+        res = self.session.get(f"{self.api_url}/directories/meta")
         directories = res.json() if res.status_code == 200 else []
         return directories
 
     def create_directory(self, directory_name, parent_id):
-        res = requests.post(f"{self.api_url}/directories", data={"name": directory_name, "parent": parent_id})
-        return res.status_code == 200
+        res = self.session.post(f"{self.api_url}/directories", data={"name": directory_name, "parent": parent_id})
+        return self._created_id(res)
 
     def delete_directory(self, directory_id):
-        res = requests.delete(f"{self.api_url}/directories/{directory_id}?recursive=true")
+        res = self.session.delete(f"{self.api_url}/directories/{directory_id}?recursive=true")
         return res.status_code == 200
 
     def add_tags(self, file_id, tags):
-        res = requests.post(f"{self.api_url}/files/{file_id}/meta/tags", data={"tags": tags})
+        res = self.session.post(f"{self.api_url}/files/{file_id}/meta/tags", data={"tags": tags})
         return res.status_code == 200
 
     def get_tags(self, file_id):
-        res = requests.get(f"{self.api_url}/files/{file_id}/meta")
-        json = res.json()
-        return json["tags"] if res.status_code == 200 and "tags" in json else []
+        meta = self.get_file_meta(file_id)
+        return meta["tags"] if meta and "tags" in meta else []
+
+    def get_file_meta(self, file_id):
+        res = self.session.get(f"{self.api_url}/files/{file_id}/meta")
+        return res.json() if res.status_code == 200 else None
 
     def remove_tags(self, file_id, tags):
-        res = requests.patch(f"{self.api_url}/files/{file_id}/meta/tags", data={"tags": tags})
+        res = self.session.patch(f"{self.api_url}/files/{file_id}/meta/tags", data={"tags": tags})
         return res.status_code == 200
 
     def rename(self, id_, new):
-        res = requests.get(f"{self.api_url}/files/{id_}/meta")
+        res = self.session.get(f"{self.api_url}/files/{id_}/meta")
         if res.status_code == 200:
-            res = requests.patch(f"{self.api_url}/files/{id_}/meta", data={"name": new})
-            return res.status_code == 200
+            return self.rename_file(id_, new)
 
-        res = requests.get(f"{self.api_url}/directories/{id_}/meta")
+        res = self.session.get(f"{self.api_url}/directories/{id_}/meta")
         if res.status_code == 200:
-            res = requests.patch(f"{self.api_url}/directories/{id_}/meta", data={"name": new})
-            return res.status_code == 200
+            return self.rename_directory(id_, new)
 
         return False
 
+    def rename_file(self, file_id, new):
+        res = self.session.patch(f"{self.api_url}/files/{file_id}/meta", data={"name": new})
+        return res.status_code == 200
+
+    def rename_directory(self, directory_id, new):
+        res = self.session.patch(f"{self.api_url}/directories/{directory_id}/meta", data={"name": new})
+        return res.status_code == 200
+
     def move(self, id_, new_parent_id):
-        res = requests.get(f"{self.api_url}/files/{id_}/meta")
+        res = self.session.get(f"{self.api_url}/files/{id_}/meta")
         if res.status_code == 200:
-            res = requests.patch(f"{self.api_url}/files/{id_}/meta", data={"directory": new_parent_id})
-            return res.status_code == 200
+            return self.move_file(id_, new_parent_id)
 
-        res = requests.get(f"{self.api_url}/directories/{id_}/meta")
+        res = self.session.get(f"{self.api_url}/directories/{id_}/meta")
         if res.status_code == 200:
-            res = requests.patch(f"{self.api_url}/directories/{id_}/meta", data={"parent": new_parent_id})
-            return res.status_code == 200
-
-    def upload(self, file, directory_id, tags):
-        file_path = file
-        file_size = os.path.getsize(file_path)
-        file_type = mimetypes.guess_type(file_path)[0]
-        post_data = {"data": [{'size': file_size, 'tags': tags, 'directory': directory_id}]}
+            return self.move_directory(id_, new_parent_id)
+
+    def move_file(self, file_id, directory_id):
+        res = self.session.patch(f"{self.api_url}/files/{file_id}/meta", data={"directory": directory_id})
+        return res.status_code == 200
+
+    def move_directory(self, directory_id, parent_id):
+        res = self.session.patch(f"{self.api_url}/directories/{directory_id}/meta", data={"parent": parent_id})
+        return res.status_code == 200
+
+    def upload(self, file, directory_id, tags, checksum=None, codec=None, name=None):
+        # file is a path or a binary file object, name defaults to the basename of the path; with a codec, the bytes
+        # are compressed on the way and checksum hashes what is sent, which is what the server stores. Returns
+        # whether the server accepted the file and its id, None when the server does not report it
+        if isinstance(file, str):
+            with open(file, 'rb') as f:
+                return self.upload(f, directory_id, tags, checksum, codec, name or os.path.basename(file))
+
+        # regular files have a known size, pipes and compressed bodies are sent with chunked transfer encoding
+        file_stat = os.fstat(file.fileno())
+        file_size = file_stat.st_size - file.tell() if stat.S_ISREG(file_stat.st_mode) and not codec else None
+        file_type = mimetypes.guess_type(name)[0]
+        if codec:
+            tags = tags + [compression.TAG_PREFIX + codec]  # tags survive servers that drop unknown metadata fields
+        data = {'size': file_size, 'tags': tags, 'directory': directory_id}
+        if file_size is None:
+            del data['size']
         if file_type:
-            post_data["data"][0]['type'] = file_type
-        files = [('files', open(file_path, 'rb'))]
+            data['type'] = file_type
+        if codec:
+            data['encoding'] = codec
 
-        response = requests.post(
+        reader = compression.CompressingReader(file, codec) if codec else file
+        if checksum:
+            reader = HashingReader(reader, checksum)
+        body = MultipartBody([('data', data)], 'files', reader, name, size=file_size, throttle=self._throttles['bulk'])
+        response = self.bulk_session.post(
                 f'{self.api_url}/files',
-                data=post_data,
-                files=files,
+                data=body.stream(),
+                headers={'Content-Type': body.content_type},
         )
 
-        return response.status_code == 200
+        return response.status_code == 200, self._created_id(response)
 
 
-    def download(self, file_id, to):
-        response = requests.get(f'{self.api_url}/files/{file_id}', stream=True)
+    @contextmanager
+    def _progress_line(self):
+        # concurrent transfers draw their progress bars on separate lines, the lowest free one
+        with self._progress_lock:
+            line = next(line for line in itertools.count() if line not in self._progress_lines)
+            self._progress_lines.add(line)
+        try:
+            yield line
+        finally:
+            with self._progress_lock:
+                self._progress_lines.discard(line)
+
+    def download(self, file_id, to, checksum=None, encoding=None, received_checksum=None):
+        # encoding returns the codec of a compressed upload, it is only asked when the body starts like one;
+        # checksum hashes the content written, received_checksum the bytes received, which the server stores
+        response = self.bulk_session.get(f'{self.api_url}/files/{file_id}', stream=True)
         if response.status_code == 200:
             attachment_filename = response.headers['Content-Disposition'].split('filename=')[1]
-            with open(os.path.join(to, attachment_filename), 'wb') as f:
-                with tqdm(total=int(response.headers['Content-Length']), unit='B', unit_scale=True, desc='Downloading', ncols=80) as pbar:
-                    for chunk in response.iter_content(chunk_size=1024):
+            path = os.path.join(to, attachment_filename)
+            with open(path, 'wb') as f, self._progress_line() as line:
+                with tqdm.tqdm(total=int(response.headers['Content-Length']), unit='B', unit_scale=True, desc='Downloading', ncols=80, position=line, leave=False, disable=in_background()) as pbar:
+                    chunks = response.iter_content(chunk_size=1024)
+                    first = next(chunks, b'')
+                    chunks = itertools.chain([first], chunks)
+                    codec = encoding() if encoding and compression.looks_compressed(first) else None
+
+                    def received(chunks):
+                        for chunk in chunks:
+                            self._throttle('bulk', chunk)
+                            pbar.update(len(chunk))
+                            if received_checksum:
+                                received_checksum.update(chunk)
+                            yield chunk
+
+                    chunks = received(chunks)
+                    for chunk in compression.decompress(codec, chunks) if codec else chunks:
                         f.write(chunk)
-                        pbar.update(len(chunk))
-            return True
-        return False
+                        if checksum:
+                            checksum.update(chunk)
+            return path
+        return None
+
+    def read(self, file_id, start=0, end=None, chunk_size=64 * 1024):
+        # bytes [start, end) of the file, a negative start counts from the end of the file
+        if end is not None and end <= start:  # empty, and not expressible as a range
+            return
+        if start < 0:
+            byte_range = f"bytes={start}"
+        else:
+            byte_range = f"bytes={start}-{end - 1 if end is not None else ''}"
+
+        with self.bulk_session.get(f'{self.api_url}/files/{file_id}', headers={'Range': byte_range}, stream=True) as response:
+            if response.status_code not in (200, 206):
+                return
+
+            chunks = (self._throttle('bulk', chunk) for chunk in response.iter_content(chunk_size=chunk_size))
+            if response.status_code == 206:
+                yield from chunks
+            else:  # the server ignored the range, skip and cut the body on our side
+                yield from slice_chunks(chunks, start, end)
+
+    def _throttle(self, lane, chunk):
+        if self._throttles[lane]:
+            self._throttles[lane].consume(len(chunk))
+        return chunk
+
+    def delete_file(self, file_id):
+        response = self.session.delete(f'{self.api_url}/files/{file_id}')
+        return response.status_code == 200
 
     def rm(self, id_):
-        response = requests.delete(f'{self.api_url}/files/{id_}')
+        response = self.session.delete(f'{self.api_url}/files/{id_}')
         if response.status_code != 200:
-            response = requests.delete(f'{self.api_url}/directories/{id_}')
+            response = self.session.delete(f'{self.api_url}/directories/{id_}')
         return response.status_code == 200
 
+    def _created_id(self, response):
+        # id of the created entity when the server reports it, None otherwise
+        if response.status_code != 200:
+            return None
+        try:
+            body = response.json()
+        except ValueError:
+            return None
+        return body.get('_id') if isinstance(body, dict) else None
+
     def _format_url(self, url, query):
+        query = {key: value for key, value in (query or {}).items() if value}
         if query:
-            url += "?"
-            for key, value in query.items():
-                if value:
-                    if type(value) == list:
-                        for v in value:
-                            url += f"{key}={v}&"
-                    else:
-                        url += f"{key}={value}&"
-            url = url[:-1]
+            url += "?" + urlencode(query, doseq=True)
         return url
\ No newline at end of file
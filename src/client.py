@@ -0,0 +1,60 @@
+import json
+import os
+import socket
+import stat
+import struct
+import sys
+import tempfile
+
+# frames exchanged with the daemon: 1 byte channel, 4 bytes big endian length, payload
+HEADER = struct.Struct('>cI')
+STDOUT = b'o'
+STDERR = b'e'
+EXIT = b'x'
+
+# in a directory only the user can enter, the shared temporary directory would let others plant a socket there
+DEFAULT_SOCKET = os.path.join(os.environ.get('XDG_RUNTIME_DIR') or os.path.join(tempfile.gettempdir(), f"telecloud-{os.getuid()}"),
+                              'telecloud.sock')
+
+
+def check_owner(path, directory=False):
+    # raises PermissionError unless path belongs to the user and, for a directory, is closed to others
+    status = os.lstat(path)
+    if status.st_uid != os.getuid():
+        raise PermissionError(f"{path} belongs to another user")
+    if directory and (not stat.S_ISDIR(status.st_mode) or status.st_mode & 0o077):
+        raise PermissionError(f"{path} is not a private directory")
+    if not directory and not stat.S_ISSOCK(status.st_mode):
+        raise PermissionError(f"{path} is not a socket")
+
+
+def read_frame(f):
+    header = f.read(HEADER.size)
+    if len(header) < HEADER.size:
+        return None, None
+    channel, size = HEADER.unpack(header)
+    return channel, f.read(size)
+
+
+def write_frame(connection, channel, payload):
+    connection.sendall(HEADER.pack(channel, len(payload)) + payload)
+
+
+def run_command(socket_path, line):
+    check_owner(socket_path)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(socket_path)
+        connection.sendall(json.dumps({"line": line}).encode() + b'\n')
+
+        with connection.makefile('rb') as f:
+            while True:
+                channel, payload = read_frame(f)
+                if channel is None:
+                    print("Connection to the daemon was lost", file=sys.stderr)
+                    return 1
+                if channel == EXIT:
+                    return int(payload)
+
+                stream = sys.stdout.buffer if channel == STDOUT else sys.stderr.buffer
+                stream.write(payload)
+                stream.flush()
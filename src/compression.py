@@ -0,0 +1,121 @@
+import importlib.util
+import os
+import zlib
+
+from src.lazy import LazyModule
+
+lzma = LazyModule('lzma')
+mimetypes = LazyModule('mimetypes')
+zstandard = LazyModule('zstandard')
+
+CODECS = ['zstd', 'zlib', 'lzma']
+
+MAGIC = {
+    'zlib': (b'\x78\x01', b'\x78\x5e', b'\x78\x9c', b'\x78\xda'),
+    'lzma': (b'\xfd7zXZ\x00',),
+    'zstd': (b'\x28\xb5\x2f\xfd',),
+}
+
+COMPRESSIBLE_TYPES = ('text/', 'application/json', 'application/xml', 'application/javascript', 'application/x-ndjson',
+                      'application/sql', 'application/x-yaml', 'application/csv', 'image/svg+xml')
+
+SAMPLE_SIZE = 64 * 1024
+SAMPLE_RATIO = 0.8
+TAG_PREFIX = 'encoding:'
+
+
+def available(codec):
+    return codec != 'zstd' or importlib.util.find_spec('zstandard') is not None
+
+
+def choose(codec):
+    if codec == 'auto':
+        return next(codec for codec in CODECS if available(codec))
+    if not available(codec):
+        raise ValueError(f"Compression codec {codec} needs the zstandard package")
+    return codec
+
+
+def is_compressible(name, path=None):
+    mime_type = mimetypes.guess_type(name)[0]
+    if mime_type and mime_type.startswith(COMPRESSIBLE_TYPES):
+        return True
+    if path is None or not os.path.isfile(path):  # streams cannot be sampled without consuming them
+        return False
+
+    # unknown or binary types are sampled, formats that are already compressed barely shrink
+    with open(path, 'rb') as f:
+        sample = f.read(SAMPLE_SIZE)
+    return len(sample) > 0 and len(zlib.compress(sample, 1)) <= len(sample) * SAMPLE_RATIO
+
+
+def compressor(codec):
+    if codec == 'zlib':
+        return zlib.compressobj(6)
+    if codec == 'lzma':
+        return lzma.LZMACompressor()
+    return zstandard.ZstdCompressor(level=3).compressobj()
+
+
+def decompressor(codec):
+    if codec == 'zlib':
+        return zlib.decompressobj()
+    if codec == 'lzma':
+        return lzma.LZMADecompressor()
+    return zstandard.ZstdDecompressor().decompressobj()
+
+
+def looks_compressed(data):
+    return any(data.startswith(MAGIC[codec]) for codec in CODECS)
+
+
+def encoding_of(meta):
+    if not meta:
+        return None
+    if meta.get('encoding') in CODECS:
+        return meta['encoding']
+    for tag in meta.get('tags') or []:
+        if tag.startswith(TAG_PREFIX) and tag[len(TAG_PREFIX):] in CODECS:
+            return tag[len(TAG_PREFIX):]
+    return None
+
+
+def decompress(codec, chunks):
+    decompressor_ = decompressor(codec)
+    for chunk in chunks:
+        data = decompressor_.decompress(chunk)
+        if data:
+            yield data
+    flush = getattr(decompressor_, 'flush', None)
+    if flush:
+        data = flush()
+        if data:
+            yield data
+
+
+class CompressingReader:
+
+    def __init__(self, file, codec, chunk_size=1024 * 1024):
+        self._file = file
+        self._compressor = compressor(codec)
+        self._chunk_size = chunk_size
+        self._buffer = b''
+        self._finished = False
+
+    def read(self, size=-1):
+        while not self._finished and (size < 0 or len(self._buffer) < size):
+            chunk = self._file.read(self._chunk_size)
+            if chunk:
+                self._buffer += self._compressor.compress(chunk)
+            else:
+                self._buffer += self._compressor.flush()
+                self._finished = True
+
+        if size < 0:
+            data, self._buffer = self._buffer, b''
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
@@ -0,0 +1,130 @@
+import contextvars
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+def bounded_map(function, items, workers=8):
+    # results are yielded in completion order, at most 2 * workers items are in flight at once,
+    # or as many as an AdaptiveLimit currently allows
+    adaptive = isinstance(workers, AdaptiveLimit)
+    with ThreadPoolExecutor(max_workers=workers.maximum if adaptive else workers) as executor:
+        pending = set()
+        for item in items:
+            while len(pending) >= (int(workers) if adaptive else workers * 2):
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+            pending.add(executor.submit(contextvars.copy_context().run, function, item))  # workers see the caller's job
+
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+
+def bounded_chain(function, items, workers=8):
+    # the elements of the iterables returned by function for each item, yielded as the workers produce them in no
+    # particular order. Workers wait while `workers` elements are queued, the consumer's pace bounds the memory used
+    items = list(items)
+    workers = int(workers)
+    elements = queue.Queue(maxsize=workers)
+    stopped = threading.Event()
+    end = object()
+
+    def put(element, error=None):
+        while not stopped.is_set():
+            try:
+                elements.put((element, error), timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce(item):
+        try:
+            for element in function(item):
+                if not put(element):
+                    return
+        except BaseException as e:
+            put(end, e)
+        else:
+            put(end)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for item in items:
+            executor.submit(contextvars.copy_context().run, produce, item)
+
+        try:
+            remaining = len(items)
+            while remaining:
+                element, error = elements.get()
+                if element is end:
+                    remaining -= 1
+                    if error is not None:
+                        raise error
+                    continue
+                yield element
+        finally:
+            stopped.set()  # a consumer that stops early or fails releases the workers
+
+
+class TokenBucket:
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or rate
+        self._tokens = self.capacity
+        self._time = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, amount):
+        # the bucket may go into debt, callers sleep until it is paid back so concurrent users share the rate
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._time) * self.rate)
+            self._time = now
+            self._tokens -= amount
+            delay = -self._tokens / self.rate if self._tokens < 0 else 0
+        if delay:
+            time.sleep(delay)
+
+
+class AdaptiveLimit:
+
+    # additive increase, multiplicative decrease of the number of requests in flight: the limit grows by about one
+    # per round of successful requests and is cut when the server errors, throttles or slows down
+    def __init__(self, initial=4, minimum=1, maximum=32, backoff=0.5, latency_backoff=0.9, tolerance=2.0):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.backoff = backoff
+        self.latency_backoff = latency_backoff
+        self.tolerance = tolerance
+        self._baseline = None
+        self._decreased_at = 0.0
+        self._lock = threading.Lock()
+
+    def __int__(self):
+        return max(self.minimum, int(self.limit))
+
+    def record(self, latency, ok):
+        with self._lock:
+            if not ok:
+                self._decrease(self.backoff, latency)
+                return
+
+            # slowly drifting minimum, sustained slowness becomes the new normal instead of shrinking forever
+            self._baseline = latency if self._baseline is None else min(latency, self._baseline + (latency - self._baseline) * 0.01)
+            if latency > self._baseline * self.tolerance:
+                self._decrease(self.latency_backoff, latency)
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+    def _decrease(self, factor, latency):
+        # once per round trip, the failures of one round are one congestion signal
+        now = time.monotonic()
+        if now - self._decreased_at >= (latency or 0.0):
+            self.limit = max(self.minimum, self.limit * factor)
+            self._decreased_at = now
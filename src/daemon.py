@@ -0,0 +1,108 @@
+import contextlib
+import io
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+
+from src.client import check_owner, write_frame, STDOUT, STDERR, EXIT
+
+
+class Daemon:
+
+    def __init__(self, interpreter, socket_path):
+        self._interpreter = interpreter
+        self._socket_path = socket_path
+        self._lock = threading.Lock()
+        self._logger = logging.getLogger('app')
+
+    def serve_forever(self):
+        directory = os.path.dirname(os.path.abspath(self._socket_path))
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        if directory != os.path.dirname(directory):  # not /
+            try:
+                check_owner(directory, directory=True)
+            except PermissionError as e:
+                raise RuntimeError(f"Refusing to serve in {directory}: {e}")
+
+        if os.path.lexists(self._socket_path):
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+                try:
+                    connection.connect(self._socket_path)
+                    raise RuntimeError(f"A daemon is already serving {self._socket_path}")
+                except (ConnectionRefusedError, FileNotFoundError):
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(self._socket_path)
+
+        daemon = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                daemon.handle(self.request, self.rfile)
+
+        umask = os.umask(0o077)  # the socket is created private, no window before a chmod
+        try:
+            server = socketserver.ThreadingUnixStreamServer(self._socket_path, Handler)
+        finally:
+            os.umask(umask)
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        self._logger.info(f"Serving commands on {self._socket_path}")
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self._socket_path)
+
+    def handle(self, connection, rfile):
+        try:
+            line = json.loads(rfile.readline())['line']
+        except (ValueError, KeyError, TypeError):
+            write_frame(connection, EXIT, b'2')
+            return
+
+        # the interpreter state (structure, caches, current directories) is shared, commands run one at a time
+        with self._lock:
+            stdout, stderr, interpreter_stdout = sys.stdout, sys.stderr, self._interpreter.stdout
+            sys.stdout = io.TextIOWrapper(io.BufferedWriter(self.Channel(connection, STDOUT)), write_through=True)
+            sys.stderr = io.TextIOWrapper(io.BufferedWriter(self.Channel(connection, STDERR)), write_through=True)
+            self._interpreter.stdout = sys.stdout  # cmd.Cmd writes help output to the stream it was built with
+            handler = logging.StreamHandler(sys.stderr)
+            handler.setFormatter(logging.Formatter('%(levelname)s - %(message)s'))
+            self._logger.addHandler(handler)
+            try:
+                self._interpreter.onecmd(line)
+                status = self._interpreter.status
+            except Exception as e:
+                self._logger.error(e)
+                status = 1
+            finally:
+                self._logger.removeHandler(handler)
+                try:
+                    sys.stdout.flush()
+                    sys.stderr.flush()
+                except OSError:
+                    pass
+                sys.stdout, sys.stderr, self._interpreter.stdout = stdout, stderr, interpreter_stdout
+
+        try:
+            write_frame(connection, EXIT, str(status).encode())
+        except OSError:
+            pass
+
+    class Channel(io.RawIOBase):
+
+        def __init__(self, connection, channel):
+            self._connection = connection
+            self._channel = channel
+
+        def writable(self):
+            return True
+
+        def write(self, data):
+            write_frame(self._connection, self._channel, bytes(data))
+            return len(data)
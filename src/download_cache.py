@@ -0,0 +1,233 @@
+import atexit
+import errno
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+
+FICLONE = 0x40049409
+
+
+class DownloadCache:
+
+    # the index is shared by every process using the cache, changes are merged into it under a file lock in batches
+    flush_every = 64
+    flush_interval = 5.0
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self._index_path = os.path.join(path, 'index.json')
+        self._lock_path = os.path.join(path, 'index.lock')
+        self._lock = threading.Lock()
+        self._logger = logging.getLogger('app')
+
+        os.makedirs(os.path.join(path, 'objects'), exist_ok=True)
+        self._index_stat = None
+        self._index = self._read_index()
+        self._pending = self._empty_pending()
+        self._size = sum(blob['size'] for blob in self._index["blobs"].values())
+        self._flushed_at = time.monotonic()
+        atexit.register(self.flush)
+
+    @staticmethod
+    def _empty_pending():
+        return {"ids": {}, "stored": {}, "blobs": {}, "used": {}}
+
+    def _read_index(self):
+        try:
+            with open(self._index_path, 'r') as f:
+                self._index_stat = self._stat(f.fileno())
+                return json.load(f)
+        except (OSError, ValueError):
+            return {"blobs": {}, "ids": {}}
+
+    def _write_index(self):
+        tmp_path = f"{self._index_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self._index, f)
+            self._index_stat = self._stat(f.fileno())
+        os.replace(tmp_path, self._index_path)
+
+    @staticmethod
+    def _stat(fd):
+        stat = os.fstat(fd)
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def _refresh(self):
+        # picks up the entries flushed by other processes, the ones not flushed yet here are kept
+        try:
+            with open(self._index_path, 'r') as f:
+                if self._stat(f.fileno()) == self._index_stat:
+                    return
+        except OSError:
+            return
+        self._index = self._read_index()
+        self._merge(self._index, self._pending)
+
+    @staticmethod
+    def _merge(index, pending):
+        index["ids"].update(pending["ids"])
+        stored = index.setdefault("stored", {})
+        for file_id, value in pending["stored"].items():
+            if value:
+                stored[file_id] = value
+            else:
+                stored.pop(file_id, None)
+        index["blobs"].update(pending["blobs"])
+        for content_hash, used in pending["used"].items():
+            blob = index["blobs"].get(content_hash)
+            if blob is not None:
+                blob['used'] = max(blob['used'], used)
+
+    def _blob_path(self, content_hash):
+        return os.path.join(self.path, 'objects', content_hash[:2], content_hash[2:])
+
+    def __contains__(self, file_id):
+        with self._lock:
+            self._refresh()
+            return file_id in self._index["ids"]
+
+    def fetch(self, file_id, meta, to):
+        with self._lock:
+            self._refresh()
+            content_hash = self._index["ids"].get(file_id)
+            blob = self._index["blobs"].get(content_hash)
+            if blob is None or not os.path.exists(self._blob_path(content_hash)):
+                return False
+
+            stored = self._index.get("stored", {}).get(file_id)
+            if stored is not None:
+                # compressed on the server, its size and sha256 are of the stored bytes, not of the cached content
+                if meta and (meta.get('sha256'), meta.get('size')) != (stored['sha256'], stored['size']):
+                    return False
+            else:
+                if meta and meta.get('size') is not None and int(meta['size']) != blob['size']:
+                    return False
+                if meta and meta.get('sha256') and meta['sha256'] != content_hash:
+                    return False
+
+            blob['used'] = self._pending["used"][content_hash] = time.time()
+            self._flush_if_due()
+
+        self._link(self._blob_path(content_hash), to)
+        self._logger.info(f"Served {to} from download cache", extra={'event': 'download'})
+        return content_hash
+
+    def store(self, file_id, path, content_hash=None, stored=None):
+        # stored: sha256 and size the server reports for a file it keeps compressed
+        if content_hash is None:
+            sha256 = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    sha256.update(chunk)
+            content_hash = sha256.hexdigest()
+        size = os.path.getsize(path)
+
+        if size > self.max_size:
+            return
+
+        blob_path = self._blob_path(content_hash)
+        if not os.path.exists(blob_path):
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            tmp_path = f"{blob_path}.{os.getpid()}.tmp"
+            self._copy(path, tmp_path)
+            os.chmod(tmp_path, 0o444)  # blobs may be hardlinked into user directories
+            os.replace(tmp_path, blob_path)
+
+        with self._lock:
+            if content_hash not in self._index["blobs"]:
+                self._size += size
+            self._pending["ids"][file_id] = content_hash
+            self._pending["stored"][file_id] = stored
+            self._pending["blobs"][content_hash] = {"size": size, "used": time.time()}
+            self._merge(self._index, self._pending)
+            self._flush_if_due()
+
+    def _flush_if_due(self):
+        pending = len(self._pending["blobs"]) + len(self._pending["used"])
+        if pending >= self.flush_every or self._size > self.max_size or time.monotonic() - self._flushed_at >= self.flush_interval:
+            self._flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if any(self._pending.values()):
+            with open(self._lock_path, 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)  # released when closed
+                self._index = self._read_index()
+                self._merge(self._index, self._pending)
+                self._evict()
+                self._write_index()
+            self._pending = self._empty_pending()
+        self._flushed_at = time.monotonic()
+
+    def _evict(self):
+        # the blobs on disk are counted rather than the indexed ones, blobs whose entry was lost are evicted too
+        blobs = {}
+        objects = os.path.join(self.path, 'objects')
+        for prefix in os.scandir(objects):
+            if not prefix.is_dir():
+                continue
+            for entry in os.scandir(prefix.path):
+                if entry.name.endswith('.tmp'):
+                    continue
+                content_hash = prefix.name + entry.name
+                blob = self._index["blobs"].get(content_hash)
+                if blob is None:
+                    stat = entry.stat()
+                    blob = {"size": stat.st_size, "used": stat.st_mtime}
+                blobs[content_hash] = blob
+
+        total = sum(blob['size'] for blob in blobs.values())
+        for content_hash, blob in sorted(blobs.items(), key=lambda item: item[1]['used']):
+            if total <= self.max_size:
+                break
+
+            try:
+                os.remove(self._blob_path(content_hash))
+            except FileNotFoundError:
+                pass
+            del blobs[content_hash]
+            total -= blob['size']
+
+        self._index["blobs"] = blobs
+        self._index["ids"] = {file_id: content_hash for file_id, content_hash in self._index["ids"].items() if content_hash in blobs}
+        self._index["stored"] = {file_id: stored for file_id, stored in self._index.get("stored", {}).items() if file_id in self._index["ids"]}
+        self._size = total
+
+    def _link(self, src, dst):
+        try:
+            self._reflink(src, dst)
+            return
+        except OSError:
+            pass
+
+        try:
+            os.link(src, dst)
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+                raise
+            shutil.copyfile(src, dst)
+
+    def _copy(self, src, dst):
+        try:
+            self._reflink(src, dst)
+        except OSError:
+            shutil.copyfile(src, dst)
+
+    @staticmethod
+    def _reflink(src, dst):
+        with open(src, 'rb') as source, open(dst, 'wb') as destination:
+            try:
+                fcntl.ioctl(destination.fileno(), FICLONE, source.fileno())
+            except OSError:
+                destination.close()
+                os.remove(dst)
+                raise
@@ -1,15 +1,25 @@
+import contextvars
 import re
 from abc import ABC, abstractmethod
+from contextlib import contextmanager
 import os
 import logging
 
+from src.concurrency import bounded_map
+from src.jobs import checkpoint
+
 
 class FileSystem(ABC):
 
+    workers = 8
+    transfer_workers = 1
+
     def __init__(self, root):
         self._root = root
         self._current = root
+        self._pinned_current = contextvars.ContextVar(f'current_{id(self)}', default=None)
         self.logger = logging.getLogger('app')
+        self._transaction = contextvars.ContextVar(f'transaction_{id(self)}', default=None)
 
     @property
     def root(self):
@@ -17,16 +27,49 @@ class FileSystem(ABC):
 
     @property
     def current(self):
-        return self._current
+        return self._pinned_current.get() or self._current
 
     @current.setter
     def current(self, path):
         path = self.format_path(path)
-        self._current = path
+        if self._pinned_current.get() is not None:
+            self._pinned_current.set(path)
+        else:
+            self._current = path
+
+    @contextmanager
+    def pinned(self, current):
+        # relative paths resolve against `current` in this context (and the workers it starts), not the shared one
+        token = self._pinned_current.set(current)
+        try:
+            yield
+        finally:
+            self._pinned_current.reset(token)
 
     def update(self):
+        transaction = self._transaction.get()
+        if transaction is not None:
+            transaction['update_pending'] = True
+            return
         self._update()
 
+    @contextmanager
+    def transaction(self):
+        # per context: a background job's transaction holds back its own refreshes, not the foreground ones, and the
+        # bounded_map workers of a transaction share its state
+        if self._transaction.get() is not None:
+            yield
+            return
+
+        transaction = {'update_pending': False}
+        token = self._transaction.set(transaction)
+        try:
+            yield
+        finally:
+            self._transaction.reset(token)
+            if transaction['update_pending']:
+                self._update()
+
     def _update(self):
         pass
 
@@ -34,20 +77,38 @@ class FileSystem(ABC):
     def listdir(self, path, files=True, directories=True):
         pass
 
+    def complete(self, text, files=True):
+        head, separator, prefix = text.rpartition('/')
+        directory = self.format_path(head or separator or '.')
+
+        completions = []
+        for name, is_dir in self._complete(directory, prefix):
+            if is_dir:
+                completions.append(f"{head}{separator}{name}/")
+            elif files:
+                completions.append(f"{head}{separator}{name}")
+        return completions
+
+    @abstractmethod
+    def _complete(self, directory, prefix):
+        pass
+
     def mkdir(self, path):
         path = self.format_path(path)
 
-        parent = self.parent(path)
-
-        if not self.isdir(parent):
-            self.mkdir(parent)
+        missing = []
+        while not self.isdir(path) and self.parent(path) != path:
+            missing.append(path)
+            path = self.parent(path)
 
-        self.create_directory(path)
+        with self.transaction():
+            for directory in reversed(missing):
+                self.create_directory(directory)
 
-        self.update()
+            self.update()
 
     def create_directory(self, path):
-        self.logger.info(f"Creating directory {path}")
+        self.logger.info(f"Creating directory {path}", extra={'event': 'mkdir'})
         self._create_directory(path)
 
     @abstractmethod
@@ -56,12 +117,14 @@ class FileSystem(ABC):
 
     def rmdir(self, path):
         path = self.format_path(path)
-        self.remove_directory(path)
 
-        self.update()
+        with self.transaction():
+            self.remove_directory(path)
+
+            self.update()
 
     def remove_directory(self, path):
-        self.logger.info(f"Removing directory {path}")
+        self.logger.info(f"Removing directory {path}", extra={'event': 'rmdir'})
 
         path = self.format_path(path)
         self._remove_directory(path)
@@ -70,19 +133,50 @@ class FileSystem(ABC):
     def _remove_directory(self, path):
         pass
 
+    def remove_tree(self, path):
+        checkpoint()
+        self.logger.info(f"Removing directory tree {path}", extra={'event': 'rm'})
+
+        path = self.format_path(path)
+        self._remove_tree(path)
+
+    @abstractmethod
+    def _remove_tree(self, path):
+        pass
+
     def remove_file(self, path):
-        self.logger.info(f"Removing file {path}")
+        checkpoint()
+        self.logger.info(f"Removing file {path}", extra={'event': 'rm'})
         self._remove_file(path)
 
     @abstractmethod
     def _remove_file(self, path):
         pass
 
-    def mv(self, src, dst):
-        src = self.format_path(src)
+    def mv(self, sources, dst, regex=None):
+        sources = self.format_paths(sources)
         dst = self.format_path(dst)
 
-        self.logger.info(f"Moving {src} to {dst}")
+        if regex:
+            sources = self.expand(sources, regex)
+
+        with self.transaction():
+            list(bounded_map(lambda src: self.move_path(src, dst), sources, self.workers))
+
+            self.update()
+
+    def expand(self, paths, regex):
+        expanded = []
+        for path in self.format_paths(paths):
+            if self.isdir(path):
+                expanded += self.filter([self.join(path, name) for name in self.listdir(path)], regex)
+            else:
+                expanded += self.filter([path], regex)
+        return expanded
+
+    def move_path(self, src, dst):
+        checkpoint()
+        self.logger.info(f"Moving {src} to {dst}", extra={'event': 'mv'})
         self._move(src, dst)
 
     @abstractmethod
@@ -91,12 +185,14 @@ class FileSystem(ABC):
 
     def clean(self, path):
         path = self.format_path(path)
-        children = self.children(path, files=False, directories=True)
-        for child in children:
-            if self.isempty(child):
-                self.rmdir(child)
 
-        self.update()
+        with self.transaction():
+            children = self.children(path, files=False, directories=True)
+            for child in children:
+                if self.isempty(child):
+                    self.rmdir(child)
+
+            self.update()
 
     @abstractmethod
     def isfile(self, path):
@@ -148,38 +244,67 @@ class FileSystem(ABC):
     def relative(self, path, start):
         return os.path.relpath(path, start)
 
-    @abstractmethod
     def get_files(self, directories, regex=None, recursive=False, tags=None):
-        pass
+        return list(self.iter_files(directories, regex, recursive, tags))
 
     @abstractmethod
+    def iter_files(self, directories, regex=None, recursive=False, tags=None):
+        pass
+
     def get_directories(self, directories, regex=None, recursive=False):
+        return list(self.iter_directories(directories, regex, recursive))
+
+    @abstractmethod
+    def iter_directories(self, directories, regex=None, recursive=False):
+        pass
+
+    @abstractmethod
+    def sizes(self, paths):
         pass
 
     def rm(self, paths, recursive=False, regex=None):
         paths = self.format_paths(paths)
 
+        trees, files, partial = [], [], []
         for path in paths:
             if self.isfile(path):
-                if regex:
-                    if re.match(regex, self.basename(path)):
-                        self.remove_file(path)
+                if not regex or re.match(regex, self.basename(path)):
+                    files.append(path)
+            elif self.isdir(path) and recursive:
+                path_trees, path_files, whole = self._plan_rm(path, regex)
+                if whole:
+                    trees.append(path)
+                else:
+                    trees += path_trees
+                    files += path_files
+                    partial.append(path)
+
+        with self.transaction():
+            list(bounded_map(self.remove_tree, trees, self.workers))
+            list(bounded_map(self.remove_file, files, self.workers))
+            for path in partial:
+                self.clean(path)
+
+            self.update()
+
+    def _plan_rm(self, directory, regex):
+        # subtrees that can be removed at once, remaining files to remove and whether the whole directory goes
+        trees, files, whole = [], [], True
+        for name in self.listdir(directory):
+            path = self.join(directory, name)
+            if self.isdir(path):
+                path_trees, path_files, path_whole = self._plan_rm(path, regex)
+                if path_whole:
+                    trees.append(path)
                 else:
-                    self.remove_file(path)
-            elif self.isdir(path):
-                if recursive:
-                    for child in self.children(path, files=True, directories=True):
-                        if self.isfile(child):
-                            if regex:
-                                if re.match(regex, self.basename(child)):
-                                    self.remove_file(child)
-                            else:
-                                self.remove_file(child)
-                    self.clean(path)
-                    if self.isempty(path):
-                        self.rmdir(path)
-
-        self.update()
+                    trees += path_trees
+                    files += path_files
+                    whole = False
+            elif not regex or re.match(regex, name):
+                files.append(path)
+            else:
+                whole = False
+        return trees, files, whole
 
     def filter(self, paths, regex):
         paths = self.format_paths(paths)
@@ -215,11 +340,11 @@ class FileSystem(ABC):
             files += self.get_files(directories, regex=regex, recursive=recursive)
 
         files = self.filter(files, regex)
-        for file in files:
-            self.tag_path(file, tags)
+        list(bounded_map(lambda file: self.tag_path(file, tags), files, self.workers))
 
     def tag_path(self, path, tags):
-        self.logger.info(f"Tagging {path} with {tags}")
+        checkpoint()
+        self.logger.info(f"Tagging {path} with {tags}", extra={'event': 'tag'})
         self._tag_path(path, tags)
 
     def _tag_path(self):
@@ -241,7 +366,7 @@ class FileSystem(ABC):
         return to_return
 
     def get_tags_path(self, path):
-        self.logger.info(f"Getting tags for {path}")
+        self.logger.info(f"Getting tags for {path}", extra={'event': 'tag'})
         return self._get_tags_path(path)
 
     def _get_tags_path(self, path):
@@ -255,59 +380,119 @@ class FileSystem(ABC):
             files += self.get_files(directories, regex=regex, recursive=recursive)
 
         files = self.filter(files, regex)
-        for file in files:
-            self._api.remove_tags(file, tags)
+        list(bounded_map(lambda file: self.untag_path(file, tags), files, self.workers))
 
     def untag_path(self, path, tags):
-        self.logger.info(f"Removing {tags} from {path}")
+        checkpoint()
+        self.logger.info(f"Removing {tags} from {path}", extra={'event': 'untag'})
         self._untag_path(path, tags)
 
     def _untag_path(self, path, tags):
         pass
 
 
-    def upload(self, local_paths, remote_paths, tags):
-        files = self.format_paths(remote_paths)
+    def upload(self, local_paths, remote_paths, tags, journal=None):
+        self.upload_stream(zip(local_paths, remote_paths), tags, journal)
+
+    def upload_stream(self, pairs, tags, journal=None):
+        # pairs are consumed as the transfers progress, parents are created before their first file is submitted
+        def with_parents(pairs):
+            for local_path, remote_path in pairs:
+                remote_path = self.format_path(remote_path)
+                parent = self.parent(remote_path)
+                if not self.isdir(parent):
+                    self.mkdir(parent)
+                yield local_path, remote_path
 
-        for path in files:
-            parent = self.parent(path)
-            if not self.isdir(parent):
-                self.mkdir(parent)
+        def upload(paths):
+            local_path, remote_path = paths
+            return self.journaled(journal, 'upload', local_path, remote_path, lambda: self.upload_file(local_path, remote_path, tags))
 
-        for index, file in enumerate(remote_paths):
-            local_path = local_paths[index]
-            remote_path = file
-            self.upload_file(local_path, remote_path, tags)
+        with self.transaction():
+            list(bounded_map(upload, with_parents(pairs), self.transfer_workers))
 
-        self.update()
+            self.update()
 
     def upload_file(self, local_path, remote_path, tags):
-        self.logger.info(f"Uploading {local_path} to {remote_path}")
-        self._upload_file(local_path, remote_path, tags)
+        checkpoint()
+        self.logger.info(f"Uploading {local_path} to {remote_path}", extra={'event': 'upload'})
+        return self._upload_file(local_path, remote_path, tags)
 
     def _upload_file(self, local_path, remote_path):
         pass
 
-    def download(self, remote_paths, local_paths):
-        files = self.format_paths(remote_paths)
-
-        for path in files:
-            parent = self.parent(path)
-            if not self.isdir(parent):
-                self.mkdir(parent)
-
-        for index, file in enumerate(local_paths):
-            remote_path = remote_paths[index]
-            local_path = file
-            self.download_file(remote_path, local_path)
+    def journaled(self, journal, direction, source, destination, transfer):
+        # transfers return whether they succeeded, a file id or path the server did not report is not a failure
+        if journal is None:
+            return transfer()
+
+        journal.start(direction, source, destination)
+        try:
+            result = transfer()
+        except Exception:
+            journal.fail(direction, source, destination)
+            raise
+        if result:
+            journal.done(direction, source, destination)
+        else:
+            journal.fail(direction, source, destination)
+        return result
+
+    def download(self, remote_paths, local_paths, journal=None):
+        self.download_stream(zip(remote_paths, local_paths), journal)
+
+    def download_stream(self, pairs, journal=None):
+        def download(paths):
+            remote_path, local_path = paths
+            return self.journaled(journal, 'download', remote_path, local_path, lambda: self.download_file(remote_path, local_path))
+
+        list(bounded_map(download, pairs, self.transfer_workers))
 
     def download_file(self, remote_path, local_path):
-        self.logger.info(f"Downloading {remote_path} to {local_path}")
-        self._download_file(remote_path, local_path)
+        checkpoint()
+        self.logger.info(f"Downloading {remote_path} to {local_path}", extra={'event': 'download'})
+        return self._download_file(remote_path, local_path)
 
     def _download_file(self, remote_path, local_path):
         pass
 
+    def read(self, path, start=0, end=None):
+        path = self.format_path(path)
+        return self._read(path, start, end)
+
+    @abstractmethod
+    def _read(self, path, start, end):
+        pass
+
+    def head(self, path, lines):
+        for chunk in self.read(path):
+            position = 0
+            while lines:
+                position = chunk.find(b'\n', position) + 1
+                if not position:
+                    break
+                lines -= 1
+            if not lines:
+                yield chunk[:position]
+                return
+            yield chunk
+
+    def tail(self, path, lines):
+        # reads windows growing from the end of the file until they hold enough lines
+        size = 64 * 1024
+        while True:
+            data = b''.join(self.read(path, -size))
+            position = len(data) - 1 if data.endswith(b'\n') else len(data)
+            for _ in range(lines):
+                position = data.rfind(b'\n', 0, position)
+                if position == -1:
+                    break
+
+            if position != -1 or len(data) < size:
+                yield data[position + 1:] if lines else b''
+                return
+            size *= 4
+
     def clear(self):
         self.logger.info(f"Clearing {self.root}")
         self._clear()
@@ -9,62 +9,69 @@ class FileSystemConnector:
         self._remote_filesystem = remote_filesystem
         self._logger = logging.getLogger('app')
 
-    def upload(self, files, directories, to, tags, regex, recursive):
-        files_from_dirs = self._local_filesystem.get_files(directories=directories, regex=regex, recursive=recursive)
-        paths_from_dirs = []
-        for file in files_from_dirs:
-            parent = None
-            for directory in directories:
-                if directory in file:
-                    parent = self._local_filesystem.format_path(directory)
-                    break
-            if parent:
-                path = self._local_filesystem.relative(file, parent)
-                paths_from_dirs.append(os.path.join(self._local_filesystem.basename(parent), path))
-
-        paths_from_dirs = [os.path.join(to, path) for path in paths_from_dirs]
-
-        files_from_files = self._local_filesystem.filter(files, regex=regex)
-        paths_from_files = [self._local_filesystem.basename(file) for file in files_from_files]
-        paths_from_files = [os.path.join(to, path) for path in paths_from_files]
-
-        local_paths = files_from_dirs + files_from_files
-        remote_paths = paths_from_dirs + paths_from_files
-
-        for index, path in enumerate(remote_paths):
-            if self._remote_filesystem.exists(path):
-                local_paths.pop(index)
-                remote_paths.pop(index)
-                self._logger.info(f"{path} already exists in remote - Skipped uploading")
-
-        self._remote_filesystem.upload(local_paths, remote_paths, tags)
-
-    def download(self, files, directories, to, tags, regex, recursive):
-        files_from_dirs = self._remote_filesystem.get_files(directories=directories, regex=regex, recursive=recursive, tags=tags) if directories else []
-        paths_from_dirs = []
-        for file in files_from_dirs:
-            parent = None
-            for directory in directories:
-                if directory in file:
-                    parent = self._remote_filesystem.format_path(directory)
-                    break
-            if parent:
-                path = self._remote_filesystem.relative(file, parent)
-                paths_from_dirs.append(os.path.join(self._remote_filesystem.basename(parent), path))
-
-        paths_from_dirs = [os.path.join(to, path) for path in paths_from_dirs]
-
-        files_from_files = self._remote_filesystem.filter(files, regex=regex)
-        paths_from_files = [self._remote_filesystem.basename(file) for file in files_from_files]
-        paths_from_files = [os.path.join(to, path) for path in paths_from_files]
-
-        remote_paths = files_from_dirs + files_from_files
-        local_paths = paths_from_dirs + paths_from_files
-
-        for index, path in enumerate(local_paths):
-            if self._local_filesystem.exists(path):
-                remote_paths.pop(index)
-                local_paths.pop(index)
-                self._logger.info(f"{path} already exists in local - Skipped downloading")
-
-        self._remote_filesystem.download(remote_paths, local_paths)
+    def upload(self, files, directories, to, tags, regex, recursive, journal=None):
+        pairs = self._plan(self._local_filesystem, self._remote_filesystem, files, directories, to, regex, recursive)
+        if journal:
+            pairs = journal.plan('upload', pairs)
+
+        exists = self._exists_index(self._remote_filesystem)
+
+        def remaining(pairs):
+            for local_path, remote_path in pairs:
+                # an upload interrupted midway or whose source changed since is uploaded again over the remote file
+                if exists(remote_path) and not (journal and journal.redo('upload', local_path, remote_path)):
+                    self._logger.info(f"{remote_path} already exists in remote - Skipped uploading")
+                    continue
+                yield local_path, remote_path
+
+        self._remote_filesystem.upload_stream(remaining(pairs), tags, journal)
+
+    def download(self, files, directories, to, tags, regex, recursive, journal=None):
+        pairs = self._plan(self._remote_filesystem, self._local_filesystem, files, directories, to, regex, recursive, tags)
+        if journal:
+            pairs = journal.plan('download', pairs)
+
+        exists = self._exists_index(self._local_filesystem)
+        parents = set()
+
+        def remaining(pairs):
+            for remote_path, local_path in pairs:
+                # a download interrupted midway leaves a partial file, it is downloaded again
+                if exists(local_path) and not (journal and journal.redo('download', remote_path, local_path)):
+                    self._logger.info(f"{local_path} already exists in local - Skipped downloading")
+                    continue
+
+                parent = os.path.dirname(local_path)
+                if parent not in parents:
+                    if not self._local_filesystem.isdir(parent):
+                        self._local_filesystem.mkdir(parent)
+                    parents.add(parent)
+                yield remote_path, local_path
+
+        self._remote_filesystem.download_stream(remaining(pairs), journal)
+
+    @staticmethod
+    def _plan(source_filesystem, destination_filesystem, files, directories, to, regex, recursive, tags=None):
+        # (source, destination) pairs are yielded while the sources are scanned, each directory is scanned on its own
+        # so the root of every file is known without searching for it
+        for directory in directories:
+            root = source_filesystem.format_path(directory)
+            prefix = destination_filesystem.format_path(os.path.join(to, source_filesystem.basename(root)))
+            for file in source_filesystem.iter_files([root], regex=regex, recursive=recursive, tags=tags):
+                yield file, os.path.join(prefix, source_filesystem.relative(file, root))
+
+        for file in source_filesystem.filter(files, regex=regex):
+            yield file, destination_filesystem.format_path(os.path.join(to, source_filesystem.basename(file)))
+
+    @staticmethod
+    def _exists_index(filesystem):
+        # one listing per destination directory instead of one lookup per file
+        listings = {}
+
+        def exists(path):
+            directory, name = os.path.split(path)
+            if directory not in listings:
+                listings[directory] = set(filesystem.listdir(directory)) if filesystem.isdir(directory) else set()
+            return name in listings[directory]
+
+        return exists
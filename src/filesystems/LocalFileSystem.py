@@ -3,12 +3,14 @@ import re
 import shutil
 
 from src.filesystems.FileSystem import FileSystem
+from src.filesystems.PathTrie import PathTrie
 
 
 class LocalFileSystem(FileSystem):
 
     def __init__(self, root_path=os.path.expanduser("~")):
         super().__init__(root_path)
+        self._completion_index = PathTrie()
 
     def listdir(self, path, files=True, directories=True):
         path = self.format_path(path)
@@ -23,12 +25,33 @@ class LocalFileSystem(FileSystem):
         return list_paths
 
 
+    def _complete(self, directory, prefix):
+        node = self._completion_index.node(directory, create=True)
+        try:
+            stamp = os.stat(directory).st_mtime_ns
+            if node.stamp != stamp:
+                with os.scandir(directory) as entries:
+                    entries = {entry.name: entry.is_dir() for entry in entries}
+                for name in list(node.children):
+                    if name not in entries:
+                        node.discard(name)
+                for name, is_dir in entries.items():
+                    node.add(name, is_dir)
+                node.stamp = stamp
+        except OSError:
+            return []
+
+        return node.complete(prefix)
+
     def _create_directory(self, path):
         os.mkdir(path)
 
     def _remove_directory(self, path):
         os.rmdir(path)
 
+    def _remove_tree(self, path):
+        shutil.rmtree(path)
+
     def _move(self, src, dst):
         shutil.move(src, dst)
 
@@ -51,38 +74,43 @@ class LocalFileSystem(FileSystem):
         path = self.format_path(path)
         return os.path.basename(path)
 
-    def get_files(self, directories, regex=None, recursive=False, tags=None):
-        directories = self.format_paths(directories)
-
-        files = []
-        for directory in directories:
-            list_paths = self.listdir(directory)
-            for path in list_paths:
-                if self.isfile(os.path.join(directory, path)):
-                    files.append(os.path.join(directory, path))
-
-                if recursive and os.path.isdir(os.path.join(directory, path)):
-                    files += self.get_files([os.path.join(directory, path)], regex, recursive, tags)
-
-        if regex:
-            files = self.filter(files, regex)
-
-        return files
-
-    def get_directories(self, directories, regex=None, recursive=False):
-        directories = self.format_paths(directories)
-
-        directories_ = []
-        for directory in directories:
-            list_paths = self.listdir(directory)
-            for path in list_paths:
-                if self.isdir(os.path.join(directory, path)):
-                    directories_.append(os.path.join(directory, path))
-
-                if recursive and os.path.isdir(os.path.join(directory, path)):
-                    directories_ += self.get_directories([os.path.join(directory, path)], regex, recursive)
-
-        if regex:
-            directories_ = self.filter(directories_, regex)
-
-        return directories_
+    def _read(self, path, start, end):
+        with open(path, 'rb') as f:
+            if start < 0:
+                f.seek(max(os.path.getsize(path) + start, 0))
+            else:
+                f.seek(start)
+
+            remaining = end - start if end is not None and start >= 0 else None
+            while remaining is None or remaining > 0:
+                chunk = f.read(64 * 1024 if remaining is None else min(64 * 1024, remaining))
+                if not chunk:
+                    return
+                if remaining is not None:
+                    remaining -= len(chunk)
+                yield chunk
+
+    def sizes(self, paths):
+        return [os.path.getsize(path) for path in self.format_paths(paths)]
+
+    def iter_files(self, directories, regex=None, recursive=False, tags=None):
+        for directory in self.format_paths(directories):
+            for name in self.listdir(directory):
+                path = os.path.join(directory, name)
+                if self.isfile(path):
+                    if not regex or re.match(regex, name):
+                        yield path
+
+                elif recursive and os.path.isdir(path):
+                    yield from self.iter_files([path], regex, recursive, tags)
+
+    def iter_directories(self, directories, regex=None, recursive=False):
+        for directory in self.format_paths(directories):
+            for name in self.listdir(directory):
+                path = os.path.join(directory, name)
+                if self.isdir(path):
+                    if not regex or re.match(regex, name):
+                        yield path
+
+                    if recursive:
+                        yield from self.iter_directories([path], regex, recursive)
@@ -0,0 +1,41 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class MetadataCache:
+
+    def __init__(self, max_entries=10000, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, id_):
+        with self._lock:
+            entry = self._entries.get(id_)
+            if entry is None:
+                return None
+
+            expires, meta = entry
+            if expires < time.monotonic():
+                del self._entries[id_]
+                return None
+
+            self._entries.move_to_end(id_)
+            return meta
+
+    def put(self, id_, meta):
+        with self._lock:
+            self._entries[id_] = (time.monotonic() + self.ttl, meta)
+            self._entries.move_to_end(id_)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, id_):
+        with self._lock:
+            self._entries.pop(id_, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,101 @@
+from datetime import datetime
+
+from src.lazy import LazyModule
+
+np = LazyModule('numpy')
+
+
+class MetadataTable:
+
+    def __init__(self, structure, files_meta):
+        self._structure = structure
+
+        self._directory_nodes = [node for _, node in structure.items() if node.is_dir]
+        self._directory_index = {id(node): index for index, node in enumerate(self._directory_nodes)}
+        self.directory_parent = np.array([self._directory_index.get(id(node.parent), index)
+                                          for index, node in enumerate(self._directory_nodes)], dtype=np.int64)
+
+        self._file_nodes = []
+        ids, parents, sizes, types, created, modified = [], [], [], [], [], []
+        type_codes = {}
+        for meta in files_meta:
+            node = structure.node_of(meta['_id'])
+            if node is None or node.is_dir:
+                continue
+
+            self._file_nodes.append(node)
+            ids.append(meta['_id'])
+            parents.append(self._directory_index[id(node.parent)])
+            sizes.append(int(meta.get('size') or 0))
+            types.append(type_codes.setdefault(meta.get('type') or '', len(type_codes)))
+            created.append(self._timestamp(meta.get('created_at')))
+            modified.append(self._timestamp(meta.get('updated_at')))
+
+        self.ids = np.array(ids, dtype=object)
+        self.parent = np.array(parents, dtype=np.int64)
+        self.size = np.array(sizes, dtype=np.int64)
+        self.type = np.array(types, dtype=np.int32)
+        self.types = list(type_codes)
+        self.created = np.array(created, dtype=np.float64)
+        self.modified = np.array(modified, dtype=np.float64)
+        self._file_index = {id_: index for index, id_ in enumerate(ids)}
+
+    def __len__(self):
+        return len(self._file_nodes)
+
+    @staticmethod
+    def _timestamp(value):
+        if isinstance(value, (int, float)):
+            return float(value)
+        if isinstance(value, str):
+            try:
+                return datetime.fromisoformat(value).timestamp()
+            except ValueError:
+                pass
+        return float('nan')
+
+    def _owners(self, directory, depth):
+        # index of the directory (depth 0) or of its child (depth 1) each directory is under, -1 when outside
+        target = self._directory_index[id(directory)]
+        owners = np.full(len(self._directory_nodes), -1, dtype=np.int64)
+        owners[target] = target
+        if depth:
+            children = np.nonzero(self.directory_parent == target)[0]
+            children = children[children != target]
+            owners[children] = children
+
+        while True:
+            inherited = np.where(owners == -1, owners[self.directory_parent], owners)
+            if np.array_equal(inherited, owners):
+                return owners
+            owners = inherited
+
+    def _select(self, directory, larger_than=None, smaller_than=None, type_prefix=None):
+        mask = self._owners(directory, depth=0)[self.parent] >= 0
+        if larger_than is not None:
+            mask &= self.size > larger_than
+        if smaller_than is not None:
+            mask &= self.size < smaller_than
+        if type_prefix:
+            codes = [code for code, type_ in enumerate(self.types) if type_.startswith(type_prefix)]
+            mask &= np.isin(self.type, codes)
+        return np.nonzero(mask)[0]
+
+    def du(self, directory):
+        owners = self._owners(directory, depth=1)[self.parent]
+        inside = owners >= 0
+        totals = np.bincount(owners[inside], weights=self.size[inside], minlength=len(self._directory_nodes))
+
+        usage = [(self._structure.path(self._directory_nodes[index]), int(totals[index]))
+                 for index in np.nonzero(totals)[0]]
+        usage.sort(key=lambda entry: entry[1], reverse=True)
+        return usage, int(totals.sum())
+
+    def find(self, directory, larger_than=None, smaller_than=None, type_prefix=None):
+        indices = self._select(directory, larger_than, smaller_than, type_prefix)
+        indices = indices[np.argsort(-self.size[indices], kind='stable')]
+        return [(self._structure.path(self._file_nodes[index]), int(self.size[index])) for index in indices]
+
+    def sizes(self, ids):
+        indices = [self._file_index.get(id_) for id_ in ids]
+        return [int(self.size[index]) if index is not None else 0 for index in indices]
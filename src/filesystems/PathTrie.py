@@ -0,0 +1,112 @@
+import bisect
+import sys
+
+
+class PathTrie:
+
+    class Node:
+        __slots__ = ('name', 'parent', 'children', 'id', 'stamp', '_names')
+
+        def __init__(self, name='', parent=None, is_dir=True):
+            self.name = name
+            self.parent = parent
+            self.children = {} if is_dir else None
+            self.id = None
+            self.stamp = None
+            self._names = None
+
+        @property
+        def is_dir(self):
+            return self.children is not None
+
+        def names(self):
+            if self._names is None:
+                self._names = sorted(self.children)
+            return self._names
+
+        def add(self, name, is_dir):
+            child = self.children.get(name)
+            if child is None:
+                name = sys.intern(name)
+                child = self.children[name] = PathTrie.Node(name, self, is_dir)
+                self._names = None
+            elif child.is_dir != is_dir:
+                child.children = {} if is_dir else None
+                child._names = None
+            return child
+
+        def attach(self, name, child):
+            child.name = sys.intern(name)
+            child.parent = self
+            self.children[child.name] = child
+            self._names = None
+
+        def discard(self, name):
+            child = self.children.pop(name, None)
+            if child is not None:
+                self._names = None
+            return child
+
+        def complete(self, prefix):
+            names = self.names()
+            index = bisect.bisect_left(names, prefix)
+            completions = []
+            while index < len(names) and names[index].startswith(prefix):
+                completions.append((names[index], self.children[names[index]].is_dir))
+                index += 1
+            return completions
+
+    def __init__(self):
+        self.root = self.Node()
+
+    @staticmethod
+    def split(path):
+        return [component for component in path.split('/') if component]
+
+    def node(self, path, create=False):
+        node = self.root
+        for component in self.split(path):
+            if not node.is_dir:
+                return None
+            child = node.children.get(component)
+            if child is None:
+                if not create:
+                    return None
+                child = node.add(component, True)
+            node = child
+        return node
+
+    def path(self, node):
+        names = []
+        while node.parent is not None:
+            names.append(node.name)
+            node = node.parent
+        return '/' + '/'.join(reversed(names))
+
+    def insert(self, path, is_dir):
+        components = self.split(path)
+        if not components:
+            return self.root
+        parent = self.node('/'.join(components[:-1]), create=True)
+        return parent.add(components[-1], is_dir) if parent is not None else None
+
+    def remove(self, path):
+        components = self.split(path)
+        if not components:
+            return None
+        parent = self.node('/'.join(components[:-1]))
+        return parent.discard(components[-1]) if parent is not None and parent.is_dir else None
+
+    def items(self, node=None):
+        node = node or self.root
+        stack = [(self.path(node), node)]
+        while stack:
+            path, node = stack.pop()
+            yield path, node
+            if node.is_dir:
+                prefix = path if path.endswith('/') else path + '/'
+                stack.extend((prefix + name, child) for name, child in list(node.children.items()))
+
+    def complete(self, directory, prefix):
+        node = self.node(directory)
+        return node.complete(prefix) if node is not None and node.is_dir else []
@@ -1,77 +1,304 @@
+import contextlib
+import contextvars
 import os
+import re
+import sys
 import logging
+import threading
+import time
+from contextlib import contextmanager
 
 from src.filesystems.FileSystem import FileSystem
-from src.api import Api
+from src.filesystems.RemoteStructure import RemoteStructure
+from src.filesystems.MetadataTable import MetadataTable
+from src.filesystems.MetadataCache import MetadataCache
+from src import compression
+from src.api import Api, slice_chunks
+from src.concurrency import bounded_map
+from src.integrity import HashingReader, Verifier
+from src.jobs import in_background
+from src.lazy import LazyModule
+
+tqdm = LazyModule('tqdm')
 
 
 class RemoteFileSystem(FileSystem):
 
-    def __init__(self, root='/', api_url='http://localhost:5000'):
+    LOAD_STEPS = 3
+    feed_wait = 30
+    feed_retry = 5
+    feed_retry_max = 300
+
+    def __init__(self, root='/', api_url='http://localhost:5000', api=None, background=False, download_cache=None):
         super().__init__(root)
-        self._api = Api(api_url)
+        self._api = api or Api(api_url, check_connection=False)
+        self._download_cache = download_cache
 
         self._logger = logging.getLogger('app')
+
+        self._structure = RemoteStructure(refresh=self._update)
+        self._metadata = None
+        self._metadata_cache = MetadataCache()
+        # per context, concurrent jobs verify and compress their own transfers only
+        self._verifier = contextvars.ContextVar(f'verifier_{id(self)}', default=None)
+        self._compression = contextvars.ContextVar(f'compression_{id(self)}', default=None)
+
+        self._loaded = threading.Event()
+        self._load_progress = 0
+        self._load_error = None
+        self._background = background
+
+        # version of the server's change feed the structure is at, None without a feed
+        self._version = None
+        self._feed = True
+        self._feed_lock = threading.Lock()
+        self._following = False
+
+        self.load(background)
+
+    @property
+    def workers(self):
+        return self._api.concurrency['interactive']
+
+    @property
+    def transfer_workers(self):
+        return self._api.concurrency['bulk']
+
+    @property
+    def loaded(self):
+        return self._loaded.is_set() and self._load_error is None
+
+    @property
+    def _files_structure(self):
+        self._ensure_structure()
+        return self._structure.files
+
+    @property
+    def _directories_structure(self):
+        self._ensure_structure()
+        return self._structure.directories
+
+    @property
+    def _full_structure(self):
+        self._ensure_structure()
+        return self._structure.entries
+
+    def _ensure_structure(self, listing=False):
+        self.wait_until_loaded()
+        if listing:
+            self._structure.refresh_if_stale()
+
+    def load(self, background=False):
+        self._loaded.clear()
+        self._load_progress = 0
+        self._load_error = None
+
+        if background:
+            threading.Thread(target=self._load, name='remote-structure-loader', daemon=True).start()
+        else:
+            self._load()
+            self.wait_until_loaded()
+
+    def wait_until_loaded(self):
+        if not self._loaded.is_set():
+            with tqdm.tqdm(total=self.LOAD_STEPS, desc='Loading remote structure', ncols=80, leave=False, disable=in_background()) as pbar:
+                while not self._loaded.wait(0.1):
+                    pbar.update(self._load_progress - pbar.n)
+                pbar.update(self._load_progress - pbar.n)
+
+        if self._load_error:
+            if self._background:
+                self.load(background=True)  # retried in background, the next remote command will wait for it
+            raise ConnectionError("Connection to the server could not be established")
+
+    def _load(self):
         try:
-            self._files_structure = self._api.get_remote_files_structure()
-            self._directories_structure = self._api.get_remote_folder_structure()
-            self._full_structure = {**self._files_structure, **self._directories_structure}
+            self._api.test_connection()
+            self._load_progress += 1
+
+            version = self._feed_version()
+            files_structure = self._api.get_remote_files_structure()
+            self._load_progress += 1
+
+            directories_structure = self._api.get_remote_folder_structure()
+            self._load_progress += 1
+
+            self._set_structure(files_structure, directories_structure, version)
+            self._logger.info("Remote file system initialized")
         except Exception as e:
-            self._logger.error(e)
-            raise ConnectionError("Connection to the server could not be established")
-        self._logger.info("Remote file system initialized")
+            self._load_error = e
+            self._logger.error(f"Failed to load remote structure: {e}")
+        finally:
+            self._loaded.set()
+
+    def _set_structure(self, files_structure, directories_structure, version=None):
+        self._structure.reset(files_structure, directories_structure)
+        self._version = version
+        self._metadata = None
+        self._load_error = None
+
+    def _feed_version(self):
+        # taken before the structure is fetched, the changes made in between are replayed on the next sync
+        if not self._feed:
+            return None
+        try:
+            feed = self._api.get_changes()
+        except Exception as e:  # the feed is kept, the next reload asks again
+            self._logger.debug(f"Change feed unavailable: {e}")
+            return None
+        if feed is None:
+            self._feed = False
+            self._logger.debug("The server has no change feed - Structure updates reload it whole")
+            return None
+        return feed['version']
+
+    def _apply_feed(self, since, feed):
+        # False when the changes could not be applied, the caller reloads the structure then
+        if feed is None or feed.get('changes') is None or feed.get('version') is None:
+            return False
+        if since != self._version:  # synced by someone else in the meantime
+            return True
+
+        changes = feed['changes']
+        applied = self._structure.apply(changes)
+        for change in changes:
+            self._metadata_cache.invalidate(change.get('id'))
+        if changes:
+            self._metadata = None
+        if applied:
+            self._version = feed['version']
+        return applied
+
+    def subscribe(self):
+        # follows the change feed in background so the structure stays fresh while other clients change the library
+        if not self._following:
+            self._following = True
+            threading.Thread(target=self._follow, name='remote-change-feed', daemon=True).start()
+
+    def _follow(self):
+        self._loaded.wait()
+        retry = self.feed_retry
+        while self._feed:
+            try:
+                since = self._version
+                if since is None:  # the version could not be read at the last reload
+                    self._update()
+                    if self._version is None:
+                        raise ConnectionError("No change feed version")
+                    continue
+
+                feed = self._api.get_changes(since, self.feed_wait)
+                if feed is None:
+                    self._feed = False
+                    break
+
+                with self._feed_lock:
+                    if not self._apply_feed(since, feed):
+                        self._reload()
+                retry = self.feed_retry
+            except Exception as e:
+                # server errors and proxies timing the long poll out, backed off and retried
+                self._logger.debug(f"Change feed unavailable: {e}")
+                time.sleep(retry)
+                retry = min(retry * 2, self.feed_retry_max)
+        self._following = False
+
+    def _structure_changed(self, applied):
+        if not applied:
+            self._structure.stale = True
+        self._metadata = None
+
+    @contextmanager
+    def verifying(self, verifier):
+        token = self._verifier.set(verifier)
+        try:
+            yield verifier
+        finally:
+            self._verifier.reset(token)
+
+    @contextmanager
+    def compressing(self, codec):
+        token = self._compression.set(compression.choose(codec) if codec else None)
+        try:
+            yield
+        finally:
+            self._compression.reset(token)
+
+    def _complete(self, directory, prefix):
+        if not self.loaded:
+            return []
+
+        self._ensure_structure(listing=True)
+        return self._structure.complete(directory, prefix)
 
     def _update(self):
-        self._files_structure = self._api.get_remote_files_structure()
-        self._directories_structure = self._api.get_remote_folder_structure()
-        self._full_structure = {**self._files_structure, **self._directories_structure}
+        # deltas of the change feed when the server has one, the whole structure otherwise
+        with self._feed_lock:
+            since = self._version
+            if since is None or not self._apply_feed(since, self._changes(since)):
+                self._reload()
+
+    def _changes(self, since):
+        try:
+            return self._api.get_changes(since)
+        except Exception as e:  # reloaded whole this time, the feed is kept
+            self._logger.debug(f"Change feed unavailable: {e}")
+            return None
+
+    def _reload(self):
+        version = self._feed_version()
+        self._set_structure(self._api.get_remote_files_structure(), self._api.get_remote_folder_structure(), version)
 
     def listdir(self, path, files=True, directories=True):
         path = self.format_path(path)
-        structure = self._full_structure
+        self._ensure_structure(listing=True)
 
-        if files and not directories:
-            structure = self._files_structure
+        node = self._structure.node(path)
+        if node is None or not node.is_dir:
+            return []
 
-        elif directories and not files:
-            structure = self._directories_structure
-
-        return [self.basename(self.format_path(path_)) for path_ in structure
-                if self.parent(path_) == self.format_path(path) and path_ != '']
+        return [name for name, child in list(node.children.items())
+                if child.id is not None and (directories if child.is_dir else files)]
 
     def _create_directory(self, path):
         parent = self.parent(path)
         parent_id = self._directories_structure[parent]
         directory_name = self.basename(path)
 
-        self._api.create_directory(directory_name, parent_id)
+        directory_id = self._api.create_directory(directory_name, parent_id)
+        self._structure_changed(directory_id and self._structure.add(path, directory_id, is_dir=True))
 
     def _remove_directory(self, path):
         directory_id = self._directories_structure[path]
-        self._api.delete_directory(directory_id)
+        self._structure_changed(self._api.delete_directory(directory_id) and self._structure.discard(path))
+
+    def _remove_tree(self, path):
+        self._remove_directory(path)  # the server deletes directories recursively
 
     def _move(self, src, dst):
         dst = self.format_path(dst)
 
-        dst_is_file = self.isfile(dst)
-        dst_exists = self.exists(dst)
+        src_is_file = self.isfile(src)
+        src_id = self._full_structure[src]
 
-        if not dst_exists:
-            src_id = self._full_structure[src]
+        if not self.exists(dst):
             dst_basename = self.basename(dst)
-            self._api.rename(src_id, dst_basename)
+            rename = self._api.rename_file if src_is_file else self._api.rename_directory
+            renamed = rename(src_id, dst_basename)
+            self._metadata_cache.invalidate(src_id)
+            self._structure_changed(renamed and self._structure.move(src, self.join(self.parent(src), dst_basename)))
 
-        elif not dst_is_file:
-            src_id = self._full_structure[src]
+        elif self.isdir(dst):
             dst_id = self._directories_structure[dst]
-            self._api.move(src_id, dst_id)
-
-
-        self.update()
+            move = self._api.move_file if src_is_file else self._api.move_directory
+            moved = move(src_id, dst_id)
+            self._metadata_cache.invalidate(src_id)
+            self._structure_changed(moved and self._structure.move(src, self.join(dst, self.basename(src))))
 
     def _remove_file(self, path):
         file_id = self._files_structure[path]
-        self._api.rm(file_id)
+        self._metadata_cache.invalidate(file_id)
+        self._structure_changed(self._api.delete_file(file_id) and self._structure.discard(path))
 
     def isfile(self, path):
         path = self.format_path(path)
@@ -87,82 +314,173 @@ class RemoteFileSystem(FileSystem):
 
     def exists(self, path):
         path = self.format_path(path)
-        return path in self._files_structure or path in self._directories_structure
+        return path in self._full_structure
 
     def basename(self, path):
         path = self.format_path(path)
         return path.split('/')[-1] if '/' in path else path
 
-    def get_files(self, directories, regex=None, recursive=False, tags=None):
+    def iter_files(self, directories, regex=None, recursive=False, tags=None):
         directories = self.format_paths(directories)
 
         if recursive:
             directories = self.get_directories(directories, recursive=True) + directories
 
         directories_ids = [self._directories_structure[directory] for directory in directories]
-        files = self._api.get_files_meta(directories=directories_ids, tags=tags)
+        for file in self._api.iter_files_meta(directories=directories_ids, tags=tags):
+            self._metadata_cache.put(file['_id'], file)
 
-        files_ = []
-        for file in files:
-            file_id = file['_id']
-            for k, v in self._files_structure.items():
-                if v == file_id:
-                    files_.append(k)
+            path = self._structure.path_of(file['_id'])
+            if path is not None and (not regex or re.match(regex, self.basename(path))):
+                yield path
 
-        if regex:
-            files_ = self.filter_entities(files_, regex)
+    def iter_directories(self, directories, regex=None, recursive=False):
+        directories = self.format_paths(directories)
+        self._ensure_structure(listing=True)
 
-        return files_
+        for directory in directories:
+            node = self._structure.node(directory)
+            if node is None or not node.is_dir:
+                continue
+
+            descendants = self._structure.items(node) if recursive else ((self.join(directory, name), child) for name, child in node.children.items())
+            for path, child in descendants:
+                if child is not node and child.is_dir and child.id is not None:
+                    if not regex or re.match(regex, child.name):
+                        yield path
+
+    def metadata(self):
+        self._ensure_structure(listing=True)
+        if self._metadata is None:
+            self._metadata = MetadataTable(self._structure, self._api.iter_files_meta(tags=None, directories=None))
+        return self._metadata
+
+    def sizes(self, paths):
+        return self.metadata().sizes([self._files_structure[path] for path in self.format_paths(paths)])
+
+    def du(self, path):
+        path = self.format_path(path)
+        return self.metadata().du(self._structure.node(path))
 
-    def get_directories(self, directories, regex=None, recursive=False):
+    def find(self, directories, regex=None, larger_than=None, smaller_than=None, type_prefix=None):
         directories = self.format_paths(directories)
 
-        directories_ = []
+        found = []
         for directory in directories:
-            if self.exists(directory):
-                for dir_ in self._directories_structure:
-                    if self.parent(dir_) == directory and dir_ != directory:
-                        directories_.append(dir_)
-
-                if recursive:
-                    directories_ += self.get_directories([os.path.join(directory, d) for d in directories_], regex, recursive)
+            found += self.metadata().find(self._structure.node(directory), larger_than, smaller_than, type_prefix)
 
         if regex:
-            directories_ = self.filter_entities(directories, regex)
+            found = [(path, size) for path, size in found if re.match(regex, self.basename(path))]
 
-        return directories_
+        return found
 
     def _tag_path(self, path, tags):
         file_id = self._files_structure[path]
         self._api.add_tags(file_id, tags)
+        self._metadata_cache.invalidate(file_id)
+
+    def _file_meta(self, file_id):
+        meta = self._metadata_cache.get(file_id)
+        if meta is None:
+            meta = self._api.get_file_meta(file_id)
+            if meta is not None:
+                self._metadata_cache.put(file_id, meta)
+        return meta
 
     def _get_tags_path(self, path):
         file_id = self._files_structure[path]
-        return self._api.get_tags(file_id)
+        meta = self._file_meta(file_id)
+        return meta["tags"] if meta and "tags" in meta else []
 
     def _untag_path(self, path, tags):
         file_id = self._files_structure[path]
         self._api.remove_tags(file_id, tags)
+        self._metadata_cache.invalidate(file_id)
 
     def _upload_file(self, local_path, remote_path, tags):
         to = self.parent(remote_path)
         to = self._directories_structure[to]
 
-        self._api.upload(local_path, to, tags)
+        name = self.basename(remote_path)
+        source = None if local_path == '-' else local_path
+        codec = self._compression.get()
+        codec = codec if codec and compression.is_compressible(name, source) else None
+
+        replaced = self._files_structure.get(remote_path)
+        checksum = Verifier.checksum()
+        sent_checksum = Verifier.checksum() if codec else None
+        with open(source, 'rb') if source else contextlib.nullcontext(sys.stdin.buffer) as f:
+            reader = HashingReader(f, checksum)
+            uploaded, file_id = self._api.upload(reader, to, tags, sent_checksum, codec=codec, name=name)
+        self._structure_changed(file_id and self._structure.add(remote_path, file_id, is_dir=False))
+
+        # the file it overwrites is deleted once the new one is stored, a failed upload leaves it in place
+        if uploaded and replaced is not None and replaced != file_id:
+            self._metadata_cache.invalidate(replaced)
+            self._structure_changed(self._api.delete_file(replaced))
+
+        verifier = self._verifier.get()
+        if verifier and uploaded:
+            meta = self._file_meta(file_id) if file_id else None
+            content_hash, expected = self._checked(verifier, local_path, meta, checksum.hexdigest(), sent_checksum and sent_checksum.hexdigest())
+            verifier.record('upload', local_path, remote_path, reader.size, content_hash, expected)
+
+        return uploaded
 
     def _download_file(self, remote_path, local_path):
         to = self.parent(local_path)
         id_ = self._files_structure[remote_path]
 
-        self._api.download(id_, to)
+        verifier = self._verifier.get()
+        content_hash = None
+        if self._download_cache and id_ in self._download_cache:
+            content_hash = self._download_cache.fetch(id_, self._file_meta(id_), local_path)
+
+        path = local_path
+        received_checksum = None
+        if not content_hash:
+            checksum = Verifier.checksum()
+            received_checksum = Verifier.checksum() if verifier else None
+            path = self._api.download(id_, to, checksum, encoding=lambda: compression.encoding_of(self._file_meta(id_)),
+                                      received_checksum=received_checksum)
+            content_hash = checksum.hexdigest()
+            if self._download_cache and path:
+                meta = self._file_meta(id_)
+                stored = {'sha256': meta.get('sha256'), 'size': meta.get('size')} if compression.encoding_of(meta) else None
+                self._download_cache.store(id_, path, content_hash, stored)
+
+        if verifier and path:
+            content_hash, expected = self._checked(verifier, remote_path, self._file_meta(id_), content_hash,
+                                                   received_checksum and received_checksum.hexdigest())
+            verifier.record('download', remote_path, path, os.path.getsize(path), content_hash, expected)
+
+        return bool(path)
+
+    @staticmethod
+    def _checked(verifier, path, meta, content_hash, stored_hash=None):
+        # hash and expected hash to record: the server's sha256 is of the stored bytes, compressed for encoded files,
+        # which are compared by the bytes sent or received, the manifest is always of the content
+        if not compression.encoding_of(meta):
+            return content_hash, verifier.expected(path, meta)
+        if stored_hash and meta.get('sha256'):
+            return stored_hash, meta['sha256']
+        return content_hash, verifier.expected(path)
+
+    def _read(self, path, start, end):
+        file_id = self._files_structure[path]
+        codec = compression.encoding_of(self._file_meta(file_id))
+        if codec is None:
+            return self._api.read(file_id, start, end)
+
+        # offsets are in the uncompressed content, the whole file is streamed through the decompressor
+        return slice_chunks(compression.decompress(codec, self._api.read(file_id)), start, end)
 
     def _clear(self):
-        files = self._files_structure.keys()
-        for file in files:
-            self._remove_file(file)
+        root = self.format_path(self.root)
+        directories = [self.join(root, directory) for directory in self.listdir(root, files=False)]
+        files = [self.join(root, file) for file in self.listdir(root, directories=False)]
 
-        directories = self._directories_structure.keys()
-        for directory in directories:
-            self._remove_directory(directory)
+        list(bounded_map(self._remove_tree, directories, self.workers))
+        list(bounded_map(self._remove_file, files, self.workers))
 
         self._update()
\ No newline at end of file
@@ -0,0 +1,139 @@
+import os
+import threading
+from collections.abc import Mapping
+
+from src.filesystems.PathTrie import PathTrie
+
+
+class RemoteStructure(PathTrie):
+
+    def __init__(self, files_structure=None, directories_structure=None, refresh=None):
+        super().__init__()
+        self._refresh = refresh
+        self._lock = threading.RLock()  # mutations may come from worker threads and background jobs
+
+        self.files = self.View(self, files=True, directories=False)
+        self.directories = self.View(self, files=False, directories=True)
+        self.entries = self.View(self, files=True, directories=True)
+
+        self.reset(files_structure, directories_structure)
+
+    def reset(self, files_structure, directories_structure):
+        with self._lock:
+            self.root = self.Node()
+            self._ids = {}
+            self.stale = False
+
+            for path, id_ in (directories_structure or {}).items():
+                self.add(path, id_, is_dir=True)
+            for path, id_ in (files_structure or {}).items():
+                self.add(path, id_, is_dir=False)
+
+    def refresh_if_stale(self):
+        # changes whose effect could not be applied locally leave the structure stale until it is read again
+        if self.stale and self._refresh:
+            self._refresh()
+
+    def add(self, path, id_, is_dir):
+        if not path:
+            return None
+
+        with self._lock:
+            node = self.insert(path, is_dir)
+            if node is not None:
+                if node.id is not None and node.id != id_:  # replaced by another entity at the same path
+                    self._ids.pop(node.id, None)
+                node.id = id_
+                self._ids[id_] = node
+            return node
+
+    def discard(self, path):
+        with self._lock:
+            node = self.remove(path)
+            if node is not None:
+                for _, removed in self.items(node):
+                    self._ids.pop(removed.id, None)
+            return node
+
+    def move(self, src, dst):
+        with self._lock:
+            parent = self.node(os.path.dirname(dst))
+            if parent is None or not parent.is_dir:
+                self.stale = True
+                return None
+
+            node = self.remove(src)
+            if node is None:
+                self.stale = True
+                return None
+
+            parent.attach(os.path.basename(dst), node)
+            return node
+
+    def apply(self, changes):
+        # changes of the server's change feed, in order, our own changes come back and are applied again harmlessly;
+        # False when one could not be applied and the structure has to be reloaded
+        with self._lock:
+            for change in changes:
+                operation, id_, path = change.get('op'), change.get('id'), change.get('path')
+                if operation == 'add':
+                    if self.add(path, id_, change.get('is_dir', False)) is None:
+                        return False
+
+                elif operation == 'remove':
+                    current = self.path_of(id_)
+                    if current is not None:
+                        self.discard(current)
+
+                elif operation == 'move':
+                    current = self.path_of(id_)
+                    if current is None or (current != path and self.move(current, path) is None):
+                        return False
+
+                elif operation != 'update':
+                    return False
+            return True
+
+    def node_of(self, id_):
+        return self._ids.get(id_)
+
+    def path_of(self, id_):
+        node = self.node_of(id_)
+        return self.path(node) if node is not None else None
+
+    class View(Mapping):
+
+        def __init__(self, structure, files, directories):
+            self._structure = structure
+            self._files = files
+            self._directories = directories
+
+        def _matches(self, node):
+            if node is None or node.id is None:
+                return False
+            return self._directories if node.is_dir else self._files
+
+        def _lookup(self, path):
+            node = self._structure.node(path)
+            if not self._matches(node) and self._structure.stale:
+                self._structure.refresh_if_stale()
+                node = self._structure.node(path)
+            return node if self._matches(node) else None
+
+        def __getitem__(self, path):
+            node = self._lookup(path)
+            if node is None:
+                raise KeyError(path)
+            return node.id
+
+        def __contains__(self, path):
+            return self._lookup(path) is not None
+
+        def __iter__(self):
+            self._structure.refresh_if_stale()
+            for path, node in self._structure.items():
+                if self._matches(node):
+                    yield path
+
+        def __len__(self):
+            return sum(1 for _ in self)
@@ -0,0 +1,85 @@
+import csv
+import hashlib
+import logging
+import os
+import threading
+
+
+class HashingReader:
+
+    def __init__(self, file, checksum):
+        self._file = file
+        self._checksum = checksum
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self._file.read(size)
+        self._checksum.update(data)
+        self.size += len(data)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+
+class Verifier:
+
+    FIELDS = ['direction', 'source', 'destination', 'size', 'sha256', 'expected', 'status']
+
+    def __init__(self, manifest=None):
+        self._expected = self._read_manifest(manifest) if manifest else {}
+        self._entries = []
+        self._lock = threading.Lock()
+        self._logger = logging.getLogger('app')
+
+    @staticmethod
+    def _read_manifest(path):
+        # sha256sum output, "<hash>  <path>" per line
+        expected = {}
+        with open(path, 'r') as f:
+            for line in f:
+                content_hash, _, name = line.strip().partition(' ')
+                name = name.strip().lstrip('*')
+                if content_hash and name:
+                    expected[name] = content_hash.lower()
+                    expected.setdefault(os.path.basename(name), content_hash.lower())
+        return expected
+
+    @staticmethod
+    def checksum():
+        return hashlib.sha256()
+
+    def expected(self, path, meta=None):
+        if meta and meta.get('sha256'):
+            return meta['sha256']
+        return self._expected.get(path) or self._expected.get(os.path.basename(path))
+
+    def record(self, direction, source, destination, size, content_hash, expected):
+        if expected is None:
+            status = 'unverified'
+        elif expected.lower() == content_hash:
+            status = 'ok'
+        else:
+            status = 'mismatch'
+            self._logger.error(f"Checksum mismatch for {source} -> {destination}: expected {expected}, got {content_hash}")
+
+        with self._lock:
+            self._entries.append({'direction': direction, 'source': source, 'destination': destination, 'size': size,
+                                  'sha256': content_hash, 'expected': expected or '', 'status': status})
+        return status
+
+    @property
+    def failures(self):
+        return [entry for entry in self._entries if entry['status'] == 'mismatch']
+
+    def summary(self):
+        counts = {}
+        for entry in self._entries:
+            counts[entry['status']] = counts.get(entry['status'], 0) + 1
+        return ', '.join(f"{count} {status}" for status, count in sorted(counts.items())) or 'nothing transferred'
+
+    def write_report(self, path):
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=self.FIELDS, delimiter='\t')
+            writer.writeheader()
+            writer.writerows(self._entries)
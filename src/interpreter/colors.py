@@ -1,13 +1,16 @@
-from termcolor import colored
 import random
 
+from src.lazy import LazyModule
+
+termcolor = LazyModule('termcolor')
+
 
 def rainbow(text, randomize=False):
     colors = ['red', 'yellow', 'green', 'cyan', 'blue', 'magenta']
     colored_text = ''
     for i, char in enumerate(text):
         color = colors[i % len(colors)] if not randomize else random.choice(colors)
-        colored_text += colored(char, color)
+        colored_text += termcolor.colored(char, color)
     return colored_text
 
 
@@ -16,7 +19,7 @@ def blue_nuances(text, randomize=False):
     colored_text = ''
     for i, char in enumerate(text):
         color = colors[i % len(colors)] if not randomize else random.choice(colors)
-        colored_text += colored(char, color)
+        colored_text += termcolor.colored(char, color)
     return colored_text
 
 
@@ -25,14 +28,14 @@ def light_theme(text, randomize=False):
     colored_text = ''
     for i, char in enumerate(text):
         color = colors[i % len(colors)] if not randomize else random.choice(colors)
-        colored_text += colored(char, color)
+        colored_text += termcolor.colored(char, color)
     return colored_text
 
 
 def bold(text: str) -> str:
-    return colored(text, attrs=['bold'])
+    return termcolor.colored(text, attrs=['bold'])
 
 
 def underline(text: str) -> str:
-    return colored(text, attrs=['underline'])
+    return termcolor.colored(text, attrs=['underline'])
 
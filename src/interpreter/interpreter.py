@@ -1,51 +1,65 @@
 import cmd
-import argparse
-from termcolor import colored
+import contextlib
+import contextvars
 import os
+import stat
+import sys
 import logging
+import threading
 
 from src.interpreter.modes import MODES
 from src.api import Api
+from src import compression
+from src.download_cache import DownloadCache
+from src.integrity import Verifier
+from src.jobs import JobManager
+from src.journal import TransferJournal
 from src.filesystems import LocalFileSystem, RemoteFileSystem, FileSystemConnector
 import src.interpreter.colors as colors
 from src.interpreter.complete_parser import CompleteParser
+from src.interpreter.units import parse_size, format_size
+from src.lazy import LazyModule
+
+argparse = LazyModule('argparse')
+termcolor = LazyModule('termcolor')
 
 
 class Interpreter(cmd.Cmd):
 
-    def __init__(self, api_url, default_mode=MODES.LOCAL):
+    def __init__(self, api_url, default_mode=MODES.LOCAL, download_cache=None, bandwidth=None):
         cmd.Cmd.__init__(self)
         self.remote_filesystem = None
         self.local_filesystem = None
-        self.mode = None
+        self._mode = None
+        self._job_mode = contextvars.ContextVar('job_mode', default=None)
         self.api = None
         self.logger = None
-        self.configure(api_url, default_mode)
+        self._local = threading.local()
+        self.status = 0
+        self.script_on_stdin = False
+        self.jobs = JobManager(self.run_job)
+        self.configure(api_url, default_mode, download_cache, bandwidth)
 
-    def configure(self, api_url, default_mode=MODES.LOCAL):
+    def configure(self, api_url, default_mode=MODES.LOCAL, download_cache=None, bandwidth=None):
         self.logger = logging.getLogger('app')
         self.logger.setLevel(logging.INFO)
         self.logger.info(f"Logging level set to {logging.getLevelName(self.logger.level)}")
 
-        self.logger.info(f"Connecting to {api_url}")
-        try:
-            self.api = Api(api_url)
-        except Exception as e:
-            self.logger.error(f"Failed to connect to {api_url}")
-            self.logger.error(e)
-            exit(1)
-        self.logger.info(f"Connected to {api_url} - Starting interpreter")
-
+        bandwidth = {lane: parse_size(str(rate)) for lane, rate in (bandwidth or {}).items() if rate}
+        self.api = Api(api_url, check_connection=False, bandwidth=bandwidth)
         self.mode = default_mode
 
         self.local_filesystem = LocalFileSystem()
-        self.remote_filesystem = RemoteFileSystem()
+        self.logger.info(f"Loading remote structure from {api_url} in background - Starting interpreter")
+        if download_cache:
+            download_cache = DownloadCache(os.path.expanduser(download_cache['path']), parse_size(str(download_cache.get('max_size', '10G'))))
+        self.remote_filesystem = RemoteFileSystem(api=self.api, background=True, download_cache=download_cache)
 
         self.prompt = self.get_prompt()
 
     def get_prompt(self):
         selected_color = 'yellow'
-        return f"[ {colored(self.local_filesystem.current, selected_color) if self.mode == MODES.LOCAL else self.local_filesystem.current} || {colored(self.remote_filesystem.current, selected_color) if self.mode == MODES.REMOTE else self.remote_filesystem.current} ]$ "
+        return f"[ {termcolor.colored(self.local_filesystem.current, selected_color) if self.mode == MODES.LOCAL else self.local_filesystem.current} || {termcolor.colored(self.remote_filesystem.current, selected_color) if self.mode == MODES.REMOTE else self.remote_filesystem.current} ]$ "
 
     def update_prompt(self):
         self.prompt = self.get_prompt()
@@ -59,15 +73,152 @@ class Interpreter(cmd.Cmd):
     def get_filesystem(self):
         return self.local_filesystem if self.mode == MODES.LOCAL else self.remote_filesystem
 
+    @property
+    def mode(self):
+        # background jobs keep the mode they were submitted in
+        return self._job_mode.get() or self._mode
+
+    @mode.setter
+    def mode(self, mode):
+        if self._job_mode.get() is not None:
+            self._job_mode.set(mode)
+        else:
+            self._mode = mode
+
+    @property
+    def status(self):
+        # per thread, background jobs have their own
+        return getattr(self._local, 'status', 0)
+
+    @status.setter
+    def status(self, status):
+        self._local.status = status
+
+    def error(self, message):
+        self.status = 1
+        self.logger.error(message)
+
+    def onecmd(self, line):
+        self.status = 0
+        if line.rstrip().endswith('&'):
+            job = self.jobs.submit(line.rstrip()[:-1].strip(), (self.mode, self.local_filesystem.current, self.remote_filesystem.current))
+            print(f"[{job.id}] {job.line}")
+            return
+
+        try:
+            with self.local_filesystem.transaction(), self.remote_filesystem.transaction():
+                return cmd.Cmd.onecmd(self, line)
+        except ConnectionError as e:
+            self.error(e)
+        except SystemExit as e:  # raised by argparse on invalid arguments or -h
+            self.status = e.code or 0
+        finally:
+            for handler in self.logger.handlers:
+                handler.flush()
+
+    def default(self, line):
+        self.error(f"Unknown command: {line}")
+
     def run(self):
         self.cmdloop('\n' + colors.rainbow("Welcome to Telecloud CLI!", randomize=True) + '\n' + 'Type help or ? to list commands.\n')
 
+    def run_batch(self, lines, stop_on_error=False):
+        failed = 0
+        self.script_on_stdin = lines is sys.stdin  # commands reading stdin would eat the rest of the script
+        with self.local_filesystem.transaction(), self.remote_filesystem.transaction():
+            for number, line in enumerate(lines, start=1):
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+
+                try:
+                    stop = self.onecmd(line)
+                except Exception as e:
+                    self.error(e)
+                    stop = False
+
+                print(f"{number}\t{self.status}\t{line}", file=sys.stderr)
+                if self.status:
+                    failed += 1
+                    if stop_on_error:
+                        break
+                if stop:
+                    break
+
+            failed += sum(1 for job in self.jobs.wait() if job.status)
+
+        self.script_on_stdin = False
+        return 1 if failed else 0
+
+    def run_job(self, line, context):
+        # the job resolves its filesystem and relative paths as they were when it was submitted, whatever is done at
+        # the prompt while it waits for a worker
+        mode, local_current, remote_current = context
+        token = self._job_mode.set(mode)
+        try:
+            with self.local_filesystem.pinned(local_current), self.remote_filesystem.pinned(remote_current):
+                self.onecmd(line)
+        finally:
+            self._job_mode.reset(token)
+        return self.status
+
     def do_exit(self, args):
         return -1
 
     def help_exit(self):
         print("Exit the interpreter.")
 
+    def do_jobs(self, args):
+        for job in self.jobs.list():
+            print(f"[{job.id}] {job.state:<9} {job.elapsed:7.1f}s {job.progress:>7} ops  {job.line}")
+        self.jobs.forget_finished()
+
+    def help_jobs(self):
+        print("List background jobs, started by ending a command with &.")
+        print("Usage: jobs")
+
+    def do_wait(self, args):
+        jobs = self.get_jobs(args)
+        if jobs is None:
+            return
+
+        for job in self.jobs.wait(jobs):
+            if job.status:
+                self.status = 1
+
+    def help_wait(self):
+        print("Wait for background jobs to finish.")
+        print("Usage: wait [job ids]")
+
+    def do_cancel(self, args):
+        if not args.split():
+            self.error("Missing job id.")
+            return
+
+        jobs = self.get_jobs(args)
+        if jobs is None:
+            return
+
+        for job in jobs:
+            job.cancel()
+
+    def help_cancel(self):
+        print("Cancel background jobs, running jobs stop before their next file.")
+        print("Usage: cancel JOB_IDS")
+
+    def get_jobs(self, args):
+        if not args.split():
+            return self.jobs.list()
+
+        jobs = []
+        for id_ in args.split():
+            job = self.jobs.get(int(id_)) if id_.isdigit() else None
+            if job is None:
+                self.error(f"No job {id_}.")
+                return None
+            jobs.append(job)
+        return jobs
+
     def do_lg(self, args):
         if self.logger.level == logging.INFO:
             self.logger.info("Logging level will be set to ERROR.")
@@ -90,10 +241,10 @@ class Interpreter(cmd.Cmd):
         filesystem = filesystem or self.get_filesystem()
 
         if should_exist and not filesystem.exists(path):
-            self.logger.error(f"Path {path} does not exist.")
+            self.error(f"Path {path} does not exist.")
             return False
         elif not should_exist and filesystem.exists(path):
-            self.logger.error(f"Path {path} already exists.")
+            self.error(f"Path {path} already exists.")
             return False
         return True
 
@@ -110,7 +261,7 @@ class Interpreter(cmd.Cmd):
             return False
 
         if not filesystem.isdir(path):
-            self.logger.error(f"Path {path} is not a directory.")
+            self.error(f"Path {path} is not a directory.")
             return False
         return True
 
@@ -127,7 +278,7 @@ class Interpreter(cmd.Cmd):
             return False
 
         if not filesystem.isfile(path):
-            self.logger.error(f"Path {path} is not a file.")
+            self.error(f"Path {path} is not a file.")
             return False
         return True
 
@@ -137,12 +288,20 @@ class Interpreter(cmd.Cmd):
                 return False
         return True
 
+    def complete_path(self, text, line, endidx, filesystem=None, files=True):
+        filesystem = filesystem or self.get_filesystem()
+
+        word = line[:endidx].split(' ')[-1]
+        offset = len(word) - len(text)  # readline only replaces the part of the word after its last delimiter
+        return [completion[offset:] for completion in filesystem.complete(word, files)]
+
     def do_ls(self, args):
         parser = argparse.ArgumentParser()
         parser.add_argument('directories', type=str, nargs='*')
         parser.add_argument('-t', "--tags", type=str, nargs='+', required=False)
         parser.add_argument('-re', "--regex", type=str, required=False)
         parser.add_argument('-r', '--recursive', action='store_true', required=False)
+        parser.add_argument('-s', '--sort', choices=['name', 'size'], required=False)
         args = parser.parse_args(args.split())
 
         if self.validate_ls(args):
@@ -156,25 +315,25 @@ class Interpreter(cmd.Cmd):
             return False
 
         if args.tags and self.mode == MODES.LOCAL:
-            self.logger.error("Tags are only available in remote mode.")
+            self.error("Tags are only available in remote mode.")
             return False
 
         return True
 
     def help_ls(self):
         print("List files and directories.")
-        print("Usage: ls [directories] [-t tags] [-re regex] [-r]")
+        print("Usage: ls [directories] [-t tags] [-re regex] [-r] [-s name|size]")
         print("Options:")
         print("  -t, --tags [tags]    Filter by tags.")
         print("  -re, --regex [regex] Filter by regex.")
         print("  -r, --recursive      List recursively.")
+        print("  -s, --sort [key]     Sort files by name or by decreasing size.")
 
     def complete_ls(self, text, line, begidx, endidx):
         last_arg_name, last_arg_value = CompleteParser.parse_line(line)
 
         if not last_arg_name:
-            filesystem = self.get_filesystem()
-            return [directory for directory in filesystem.listdir(filesystem.current, files=False) if directory.startswith(text)]
+            return self.complete_path(text, line, endidx, files=False)
 
     def ls(self, args):
         filesystem = self.get_filesystem()
@@ -184,24 +343,191 @@ class Interpreter(cmd.Cmd):
         regex = args.regex or None
         recursive = args.recursive or False
 
-        files = filesystem.get_files(directories, regex, recursive, tags)
-        directories_ = filesystem.get_directories(directories, regex, recursive)
+        files = filesystem.iter_files(directories, regex, recursive, tags)
+        directories_ = filesystem.iter_directories(directories, regex, recursive)
 
-        filenames = [filesystem.basename(file) for file in files]
-        directory_names = [filesystem.basename(directory) for directory in directories_]
+        if args.sort == 'name':
+            files = sorted(files, key=filesystem.basename)
+            directories_ = sorted(directories_, key=filesystem.basename)
+        elif args.sort == 'size':
+            files = list(files)
+            sizes = dict(zip(files, filesystem.sizes(files)))
+            files.sort(key=lambda file: sizes[file], reverse=True)
 
-        for filename in filenames:
-            self.print_file(filename)
+        for file in files:
+            self.print_file(filesystem.basename(file))
 
         if not args.tags:
-            for directory_name in directory_names:
-                self.print_directory(directory_name)
+            for directory in directories_:
+                self.print_directory(filesystem.basename(directory))
 
     def print_file(self, file):
         print(file)
 
     def print_directory(self, directory):
-        print(colored(directory, 'blue'))
+        print(termcolor.colored(directory, 'blue'))
+
+    def do_du(self, args):
+        parser = argparse.ArgumentParser()
+        parser.add_argument('directories', type=str, nargs='*')
+        parser.add_argument('-s', '--summarize', action='store_true', help='Only print the total of each directory.')
+        args = parser.parse_args(args.split())
+
+        if self.validate_du(args):
+            self.du(args)
+
+    def help_du(self):
+        print("Show disk usage of remote directories, largest subdirectories first.")
+        print("Usage: du [directories] [-s]")
+        print("Options:")
+        print("  -s, --summarize      Only print the total of each directory.")
+
+    def complete_du(self, text, line, begidx, endidx):
+        return self.complete_path(text, line, endidx, files=False)
+
+    def validate_du(self, args):
+        if self.mode == MODES.LOCAL:
+            self.error("du is only available in remote mode.")
+            return False
+
+        return self.validate_directories(args.directories or [self.remote_filesystem.current])
+
+    def du(self, args):
+        filesystem = self.get_filesystem()
+        directories = args.directories or [filesystem.current]
+
+        for directory in directories:
+            usage, total = filesystem.du(directory)
+            if not args.summarize:
+                for path, size in usage:
+                    print(f"{format_size(size):>8}  {filesystem.relative(path, filesystem.current)}")
+            print(f"{format_size(total):>8}  {termcolor.colored(directory, 'blue')}")
+
+    def do_find(self, args):
+        parser = argparse.ArgumentParser()
+        parser.add_argument('directories', type=str, nargs='*')
+        parser.add_argument('-re', '--regex', type=str, required=False)
+        parser.add_argument('--larger-than', type=parse_size, required=False)
+        parser.add_argument('--smaller-than', type=parse_size, required=False)
+        parser.add_argument('--type', type=str, required=False)
+        args = parser.parse_args(args.split())
+
+        if self.validate_find(args):
+            self.find(args)
+
+    def help_find(self):
+        print("Find remote files by size and type, largest first.")
+        print("Usage: find [directories] [-re regex] [--larger-than size] [--smaller-than size] [--type type]")
+        print("Options:")
+        print("  -re, --regex [regex]        Filter by regex.")
+        print("  --larger-than [size]        Only files larger than size (e.g. 100M, 2G).")
+        print("  --smaller-than [size]       Only files smaller than size.")
+        print("  --type [type]               Only files whose mime type starts with type (e.g. video/).")
+
+    def complete_find(self, text, line, begidx, endidx):
+        last_arg_name, last_arg_value = CompleteParser.parse_line(line)
+
+        if not last_arg_name:
+            return self.complete_path(text, line, endidx, files=False)
+
+    def validate_find(self, args):
+        if self.mode == MODES.LOCAL:
+            self.error("find is only available in remote mode.")
+            return False
+
+        return self.validate_directories(args.directories or [self.remote_filesystem.current])
+
+    def find(self, args):
+        filesystem = self.get_filesystem()
+        directories = args.directories or [filesystem.current]
+
+        found = filesystem.find(directories, args.regex, args.larger_than, args.smaller_than, args.type)
+        for path, size in found:
+            print(f"{format_size(size):>8}  {filesystem.relative(path, filesystem.current)}")
+
+    def do_cat(self, args):
+        parser = argparse.ArgumentParser()
+        parser.add_argument('files', nargs='+', help='Files to print.')
+        args = parser.parse_args(args.split())
+
+        if self.validate_files(args.files):
+            self.cat(args)
+
+    def help_cat(self):
+        print("Print files, remote files are streamed without being downloaded.")
+        print("Usage: cat FILES")
+
+    def complete_cat(self, text, line, begidx, endidx):
+        return self.complete_path(text, line, endidx)
+
+    def cat(self, args):
+        filesystem = self.get_filesystem()
+        for file in args.files:
+            self.write(filesystem.read(file))
+
+    def do_head(self, args):
+        parser = self.get_head_parser()
+        args = parser.parse_args(args.split())
+
+        if self.validate_file(args.file):
+            self.head(args)
+
+    def help_head(self):
+        print("Print the beginning of a file, only the bytes needed are fetched from the server.")
+        print("Usage: head FILE [-n lines] [-c bytes]")
+        print("Options:")
+        print("  -n, --lines [lines]  Number of lines to print, 10 by default.")
+        print("  -c, --bytes [bytes]  Number of bytes to print (e.g. 1K, 2M).")
+
+    def complete_head(self, text, line, begidx, endidx):
+        last_arg_name, last_arg_value = CompleteParser.parse_line(line)
+
+        if not last_arg_name:
+            return self.complete_path(text, line, endidx)
+
+    def get_head_parser(self):
+        parser = argparse.ArgumentParser()
+        parser.add_argument('file', help='File to print.')
+        parser.add_argument('-n', '--lines', type=int, default=10)
+        parser.add_argument('-c', '--bytes', type=parse_size, required=False)
+        return parser
+
+    def head(self, args):
+        filesystem = self.get_filesystem()
+        if args.bytes is not None:
+            self.write(filesystem.read(args.file, 0, args.bytes))
+        else:
+            self.write(filesystem.head(args.file, args.lines))
+
+    def do_tail(self, args):
+        parser = self.get_head_parser()
+        args = parser.parse_args(args.split())
+
+        if self.validate_file(args.file):
+            self.tail(args)
+
+    def help_tail(self):
+        print("Print the end of a file, only the bytes needed are fetched from the server.")
+        print("Usage: tail FILE [-n lines] [-c bytes]")
+        print("Options:")
+        print("  -n, --lines [lines]  Number of lines to print, 10 by default.")
+        print("  -c, --bytes [bytes]  Number of bytes to print (e.g. 1K, 2M).")
+
+    def complete_tail(self, text, line, begidx, endidx):
+        return self.complete_head(text, line, begidx, endidx)
+
+    def tail(self, args):
+        filesystem = self.get_filesystem()
+        if args.bytes is not None:
+            self.write(filesystem.read(args.file, -args.bytes) if args.bytes else [])
+        else:
+            self.write(filesystem.tail(args.file, args.lines))
+
+    def write(self, chunks):
+        sys.stdout.flush()
+        for chunk in chunks:
+            sys.stdout.buffer.write(chunk)
+        sys.stdout.buffer.flush()
 
     @update_prompt_decorator
     def do_cd(self, directory):
@@ -213,8 +539,7 @@ class Interpreter(cmd.Cmd):
         print("Usage: cd DIRECTORY")
 
     def complete_cd(self, text, line, begidx, endidx):
-        filesystem = self.get_filesystem()
-        return [directory for directory in filesystem.listdir(filesystem.current, files=False) if directory.startswith(text)]
+        return self.complete_path(text, line, endidx, files=False)
 
     def validate_cd(self, directory):
         filesystem = self.get_filesystem()
@@ -248,14 +573,13 @@ class Interpreter(cmd.Cmd):
         print("Usage: rmdir DIRECTORY")
 
     def complete_rmdir(self, text, line, begidx, endidx):
-        filesystem = self.get_filesystem()
-        return [directory for directory in filesystem.listdir(filesystem.current, files=False) if directory.startswith(text)]
+        return self.complete_path(text, line, endidx, files=False)
 
     def validate_rmdir(self, directory):
         filesystem = self.get_filesystem()
 
         if not filesystem.isempty(directory):
-            self.logger.error(f"Directory {directory} is not empty.")
+            self.error(f"Directory {directory} is not empty.")
             return False
 
         return self.validate_directory(directory, filesystem, should_exist=True)
@@ -283,13 +607,10 @@ class Interpreter(cmd.Cmd):
         print("  -re, --regex [regex] Filter by regex.")
 
     def complete_rm(self, text, line, begidx, endidx):
-        filesystem = self.get_filesystem()
         last_arg_name, last_arg_value = CompleteParser.parse_line(line)
 
-        if not last_arg_name and last_arg_name not in ['-r', '--recursive']:
-            return [file for file in filesystem.listdir(filesystem.current, files=True) if file.startswith(text)]
-        if not last_arg_name and last_arg_name in ['-r', '--recursive']:
-            return [path for path in filesystem.listdir(filesystem.current) if path.startswith(text)]
+        if not last_arg_name or last_arg_name in ['-r', '--recursive']:
+            return self.complete_path(text, line, endidx)
 
     def validate_rm(self, args):
         filesystem = self.get_filesystem()
@@ -313,57 +634,63 @@ class Interpreter(cmd.Cmd):
 
     def do_mv(self, args):
         parser = argparse.ArgumentParser()
-        parser.add_argument('old', help='Old file path.')
-        parser.add_argument('new', help='New file path.')
+        parser.add_argument('paths', nargs='+', help='Paths to move, followed by the destination.')
+        parser.add_argument('-re', '--regex', help='Regex to filter the moved paths, directories are expanded to their content.')
         args = parser.parse_args(args.split())
 
         if self.validate_mv(args):
             self.mv(args)
 
     def help_mv(self):
-        print("Move a file.")
+        print("Move or rename files and directories.")
         print("Usage: mv OLD NEW")
+        print("       mv SOURCES... DIRECTORY [-re regex]")
+        print("Options:")
+        print("  -re, --regex [regex] Move the entries of the sources matching regex.")
 
     def complete_mv(self, text, line, begidx, endidx):
-        filesystem = self.get_filesystem()
         last_arg_name, last_arg_value = CompleteParser.parse_line(line)
 
         if not last_arg_name:
-            return [path for path in filesystem.listdir(filesystem.current) if path.startswith(text)]
+            return self.complete_path(text, line, endidx)
 
     def validate_mv(self, args):
         filesystem = self.get_filesystem()
-        old = args.old
-        new = args.new
-
-        old_is_file = filesystem.isfile(old)
-        new_is_file = filesystem.isfile(new)
 
-        if not self.validate_path(old, filesystem, should_exist=True):
+        if len(args.paths) < 2:
+            self.error("Missing destination.")
             return False
 
-        if old_is_file and new_is_file:
-            self.logger.error(f"Cannot move a file to another file.")
-            return False
+        sources = args.paths[:-1]
+        new = args.paths[-1]
 
-        if not old_is_file and new_is_file:
-            self.logger.error(f"Cannot move a directory to a file.")
+        if not self.validate_paths(sources, filesystem, should_exist=True):
             return False
 
-        if not new_is_file:
-            basename = filesystem.basename(old)
-            new = filesystem.join(new, basename)
-            if not self.validate_path(new, filesystem, should_exist=False):
+        new_is_file = filesystem.isfile(new)
+
+        if len(sources) > 1 or args.regex:
+            if not self.validate_directory(new, filesystem, should_exist=True):
                 return False
+        elif new_is_file:
+            old_is_file = filesystem.isfile(sources[0])
+            self.error("Cannot move a file to another file." if old_is_file else "Cannot move a directory to a file.")
+            return False
+
+        if filesystem.isdir(new):
+            to_move = filesystem.expand(sources, args.regex) if args.regex else sources
+            for old in to_move:
+                if not self.validate_path(filesystem.join(new, filesystem.basename(old)), filesystem, should_exist=False):
+                    return False
 
         return True
 
     def mv(self, args):
         filesystem = self.get_filesystem()
-        old = args.old
-        new = args.new
+        sources = args.paths[:-1]
+        new = args.paths[-1]
 
-        filesystem.mv(old, new)
+        filesystem.mv(sources, new, args.regex)
 
     def do_tag(self, args):
         parser = argparse.ArgumentParser()
@@ -389,22 +716,19 @@ class Interpreter(cmd.Cmd):
         print("  -s, --show           Show tags.")
 
     def complete_tag(self, text, line, begidx, endidx):
-        filesystem = self.get_filesystem()
         last_arg_name, last_arg_value = CompleteParser.parse_line(line)
 
         if last_arg_name in ['-d', '--directories']:
-            return [path for path in filesystem.listdir(filesystem.current, files=False) if path.startswith(last_arg_value)]
-        elif last_arg_name in ['-f', '--files']:
-            return [file for file in filesystem.listdir(filesystem.current, directories=False) if file.startswith(last_arg_value)]
-        elif last_arg_name in ['-s', '--show']:
-            return [path for path in filesystem.listdir(filesystem.current, directories=False) if path.startswith(last_arg_value)]
+            return self.complete_path(text, line, endidx, files=False)
+        elif last_arg_name in ['-f', '--files', '-s', '--show']:
+            return self.complete_path(text, line, endidx)
 
     def validate_tag(self, args):
         files = args.files or []
         directories = args.directories or []
 
         if self.mode == MODES.LOCAL:
-            self.logger.error("Cannot tag files in local mode.")
+            self.error("Cannot tag files in local mode.")
             return False
 
         return self.validate_files(files, should_exist=True) and self.validate_directories(directories, should_exist=True)
@@ -432,10 +756,10 @@ class Interpreter(cmd.Cmd):
                 path = filesystem.relative(file[0], filesystem.current)
 
                 tags_color = 'yellow'
-                tags = [colored(f"#{tag}", tags_color) for tag in file[1]]
+                tags = [termcolor.colored(f"#{tag}", tags_color) for tag in file[1]]
                 tags_str = ', '.join(tags)
 
-                print(f"{path}: {colored(tags_str, 'yellow')}")
+                print(f"{path}: {termcolor.colored(tags_str, 'yellow')}")
 
     def do_untag(self, args):
         parser = argparse.ArgumentParser()
@@ -459,20 +783,19 @@ class Interpreter(cmd.Cmd):
         print("  -f, --files          Files to untag.")
 
     def complete_untag(self, text, line, begidx, endidx):
-        filesystem = self.get_filesystem()
         last_arg_name, last_arg_value = CompleteParser.parse_line(line)
 
         if last_arg_name in ['-d', '--directories']:
-            return [path for path in filesystem.listdir(filesystem.current, files=False) if path.startswith(last_arg_value)]
+            return self.complete_path(text, line, endidx, files=False)
         elif last_arg_name in ['-f', '--files']:
-            return [file for file in filesystem.listdir(filesystem.current, directories=False) if file.startswith(last_arg_value)]
+            return self.complete_path(text, line, endidx)
 
     def validate_untag(self, args):
         files = args.files or []
         directories = args.directories or []
 
         if self.mode == MODES.LOCAL:
-            self.logger.error("Cannot untag files in local mode.")
+            self.error("Cannot untag files in local mode.")
             return False
 
         return self.validate_files(files, should_exist=True) and self.validate_directories(directories, should_exist=True)
@@ -496,6 +819,9 @@ class Interpreter(cmd.Cmd):
         parser.add_argument('-r', '--recursive', action='store_true', help='Upload recursively.')
         parser.add_argument('-t', '--tags', nargs='+', help='Tags to be added to the files.', default=[])
         parser.add_argument('-re', '--regex', help='Regex to filter files.')
+        parser.add_argument('-n', '--name', help='Remote name of the uploaded file, required to upload from stdin.')
+        parser.add_argument('-z', '--compress', nargs='?', const='auto', choices=['auto'] + compression.CODECS, help='Compress compressible files while uploading them.')
+        self.add_verification_arguments(parser)
         args = parser.parse_args(args.split())
 
         if self.validate_upload(args):
@@ -503,48 +829,81 @@ class Interpreter(cmd.Cmd):
 
     def help_upload(self):
         print("Upload files to the remote server.")
-        print("Usage: upload [-to directory] [-d directories] [-r] [-t tags] [-re regex] [files]")
+        print("Usage: upload [-to directory] [-d directories] [-r] [-t tags] [-re regex] [-n name] [files]")
         print("Options:")
         print("  -to, --to [directory] Directory to upload the files to.")
         print("  -d, --directories      Directories to be uploaded.")
         print("  -r, --recursive        Upload recursively.")
         print("  -t, --tags             Tags to be added to the files.")
         print("  -re, --regex [regex]   Filter by regex.")
+        print("  -n, --name [name]      Remote name of the uploaded file. Files can be - for stdin or named pipes,")
+        print("                         they are streamed without being buffered to disk.")
+        print("  -z, --compress [codec] Compress text and other compressible files while uploading them,")
+        print("                         with zstd (if installed), zlib or lzma. They are decompressed on download.")
+        self.help_verification()
 
     def complete_upload(self, text, line, begidx, endidx):
         last_arg_name, last_arg_value = CompleteParser.parse_line(line)
 
         if not last_arg_name:
-            local_paths = self.local_filesystem.listdir(self.local_filesystem.current, directories=False)
-            return [path for path in local_paths if path.startswith(last_arg_value)]
+            return self.complete_path(text, line, endidx, filesystem=self.local_filesystem)
 
         if last_arg_name in ['-to', '--to']:
-            remote_paths = self.remote_filesystem.listdir(self.remote_filesystem.current, files=False)
-            return [path for path in remote_paths if path.startswith(last_arg_value)]
+            return self.complete_path(text, line, endidx, filesystem=self.remote_filesystem, files=False)
 
         if last_arg_name in ['-d', '--directories']:
-            local_paths = self.local_filesystem.listdir(self.local_filesystem.current, files=False)
-            return [path for path in local_paths if path.startswith(last_arg_value)]
+            return self.complete_path(text, line, endidx, filesystem=self.local_filesystem, files=False)
+
+
+    def stream_sources(self, files):
+        # stdin and named pipes can only be read once, they are uploaded as they are read
+        def is_fifo(file):
+            path = self.local_filesystem.format_path(file)
+            return os.path.exists(path) and stat.S_ISFIFO(os.stat(path).st_mode)
 
+        return [file for file in files if file == '-' or is_fifo(file)]
 
     def validate_upload(self, args):
         files = args.files or []
         directories = args.directories or []
         to = args.to or self.remote_filesystem.current
+        streams = self.stream_sources(files)
 
-        if not self.validate_files(files, should_exist=True, filesystem=self.local_filesystem):
+        if '-' in files and self.script_on_stdin:
+            self.error("Cannot upload from stdin while the batch script is read from it.")
+            return False
+
+        if '-' in files and not args.name:
+            self.error("Uploading from stdin needs a --name.")
+            return False
+
+        if args.name and (len(files) != 1 or directories):
+            self.error("--name can only be used to upload a single file.")
+            return False
+
+        if not self.validate_files([file for file in files if file not in streams], should_exist=True, filesystem=self.local_filesystem):
             return False
 
         if not self.validate_directories(directories, should_exist=True, filesystem=self.local_filesystem):
             return False
 
+        if args.manifest and not self.validate_file(args.manifest, filesystem=self.local_filesystem):
+            return False
+
+        if args.compress and not compression.available(args.compress):
+            self.error(f"Compression with {args.compress} needs the zstandard package.")
+            return False
+
         if not self.remote_filesystem.exists(to):
-            self.logger.error("Directory '{}' does not exist.".format(args.to))
+            self.error("Directory '{}' does not exist.".format(args.to))
             return False
 
+        # journaled files are skipped or redone according to the journal, streams are not journaled
         for file in files:
-            if self.remote_filesystem.exists(os.path.join(to, os.path.basename(file))):
-                self.logger.error("File '{}' already exists.".format(file))
+            if args.journal and file not in streams and not args.name:
+                continue
+            if self.remote_filesystem.exists(os.path.join(to, args.name or os.path.basename(file))):
+                self.error("File '{}' already exists.".format(args.name or file))
                 return False
 
         return True
@@ -557,8 +916,21 @@ class Interpreter(cmd.Cmd):
         regex = args.regex
         recursive = args.recursive
 
+        # renamed files and streams skip the connector, a stream cannot be filtered, planned or resumed
+        streams = files if args.name else self.stream_sources(files)
+        files = [file for file in files if file not in streams]
+        local_streams = [stream if stream == '-' else self.local_filesystem.format_path(stream) for stream in streams]
+        remote_streams = [os.path.join(to, args.name or os.path.basename(stream)) for stream in streams]
+
+        def transfer():
+            if streams:
+                self.remote_filesystem.upload(local_streams, remote_streams, tags)
+            if files or directories:
+                filesystem_connector.upload(files, directories, to, tags, regex, recursive, journal)
+
         filesystem_connector = FileSystemConnector(self.local_filesystem, self.remote_filesystem)
-        filesystem_connector.upload(files, directories, to, tags, regex, recursive)
+        with self.journal(args) as journal, self.remote_filesystem.compressing(args.compress):
+            self.verified(args, transfer)
 
     def do_download(self, args):
         parser = argparse.ArgumentParser()
@@ -568,6 +940,7 @@ class Interpreter(cmd.Cmd):
         parser.add_argument('-r', '--recursive', action='store_true', help='Download recursively.')
         parser.add_argument('-re', '--regex', help='Regex to filter files.')
         parser.add_argument('-t', '--tags', nargs='+', help='Filter by tags.')
+        self.add_verification_arguments(parser)
         args = parser.parse_args(args.split())
 
         if self.validate_download(args):
@@ -582,6 +955,7 @@ class Interpreter(cmd.Cmd):
         print("  -r, --recursive        Download recursively.")
         print("  -re, --regex [regex]   Filter by regex.")
         print("  -t, --tags             Filter by tags.")
+        self.help_verification()
 
     def validate_download(self, args):
         files = args.files or []
@@ -594,13 +968,18 @@ class Interpreter(cmd.Cmd):
         if not self.validate_directories(directories, should_exist=True, filesystem=self.remote_filesystem):
             return False
 
+        if args.manifest and not self.validate_file(args.manifest, filesystem=self.local_filesystem):
+            return False
+
         if not self.local_filesystem.exists(to):
-            self.logger.error("Directory '{}' does not exist.".format(args.to))
+            self.error("Directory '{}' does not exist.".format(args.to))
             return False
 
         for file in files:
+            if args.journal:  # skipped or redone according to the journal
+                break
             if self.local_filesystem.exists(os.path.join(to, os.path.basename(file))):
-                self.logger.error("File '{}' already exists.".format(file))
+                self.error("File '{}' already exists.".format(file))
                 return False
 
         return True
@@ -614,22 +993,54 @@ class Interpreter(cmd.Cmd):
         recursive = args.recursive
 
         filesystem_connector = FileSystemConnector(self.local_filesystem, self.remote_filesystem)
-        filesystem_connector.download(files, directories, to, tags, regex, recursive)
+        with self.journal(args) as journal:
+            self.verified(args, lambda: filesystem_connector.download(files, directories, to, tags, regex, recursive, journal))
+
+    def journal(self, args):
+        if not args.journal:
+            return contextlib.nullcontext()
+        return TransferJournal(self.local_filesystem.format_path(args.journal))
+
+    def add_verification_arguments(self, parser):
+        parser.add_argument('--verify', action='store_true', help='Check the checksums computed during the transfer.')
+        parser.add_argument('--manifest', help='sha256sum file with the expected checksums.')
+        parser.add_argument('--report', help='File to write the verification report to.')
+        parser.add_argument('--journal', help='Journal file recording the progress of the transfer, rerunning the command with it resumes the transfer.')
+
+    def help_verification(self):
+        print("  --verify               Check the sha256 of each file, computed while it is transferred,")
+        print("                         against the one reported by the server or the manifest.")
+        print("  --manifest [file]      sha256sum file with the expected checksums, implies --verify.")
+        print("  --report [file]        Write a tab separated verification report, implies --verify.")
+        print("  --journal [file]       Record the progress of the transfer in file, running the same")
+        print("                         command with it again only transfers what was not finished.")
+
+    def verified(self, args, transfer):
+        if not (args.verify or args.manifest or args.report):
+            transfer()
+            return
+
+        verifier = Verifier(self.local_filesystem.format_path(args.manifest) if args.manifest else None)
+        with self.remote_filesystem.verifying(verifier):
+            transfer()
+
+        self.logger.info(f"Verification: {verifier.summary()}")
+        if args.report:
+            verifier.write_report(self.local_filesystem.format_path(args.report))
+        if verifier.failures:
+            self.error(f"{len(verifier.failures)} files failed verification.")
 
     def complete_download(self, text, line, begidx, endidx):
         last_arg_name, last_arg_value = CompleteParser.parse_line(line)
 
         if not last_arg_name:
-            remote_paths = self.remote_filesystem.listdir(self.remote_filesystem.current, directories=False)
-            return [path for path in remote_paths if path.startswith(last_arg_value)]
+            return self.complete_path(text, line, endidx, filesystem=self.remote_filesystem)
 
         if last_arg_name in ['-to', '--to']:
-            local_paths = self.local_filesystem.listdir(self.local_filesystem.current, files=False)
-            return [path for path in local_paths if path.startswith(last_arg_value)]
+            return self.complete_path(text, line, endidx, filesystem=self.local_filesystem, files=False)
 
         if last_arg_name in ['-d', '--directories']:
-            remote_paths = self.remote_filesystem.listdir(self.remote_filesystem.current, files=False)
-            return [path for path in remote_paths if path.startswith(last_arg_value)]
+            return self.complete_path(text, line, endidx, filesystem=self.remote_filesystem, files=False)
 
     def do_clear(self, args):
         self.remote_filesystem.clear()
@@ -0,0 +1,19 @@
+import re
+
+UNITS = ['B', 'K', 'M', 'G', 'T', 'P']
+
+
+def parse_size(text):
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([BKMGTP]?)B?\s*', text, re.IGNORECASE)
+    if not match:
+        raise ValueError(f"Invalid size: {text}")
+    value, unit = match.groups()
+    return int(float(value) * 1024 ** UNITS.index(unit.upper() or 'B'))
+
+
+def format_size(size):
+    size = float(size)
+    for unit in UNITS:
+        if size < 1024 or unit == UNITS[-1]:
+            return f"{size:.0f}{unit}" if unit == 'B' else f"{size:.1f}{unit}"
+        size /= 1024
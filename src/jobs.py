@@ -0,0 +1,122 @@
+import contextvars
+import itertools
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+current_job = contextvars.ContextVar('current_job', default=None)
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def checkpoint():
+    # called between per-file operations, raises in cancelled jobs and counts progress
+    job = current_job.get()
+    if job is not None:
+        job.checkpoint()
+
+
+def in_background():
+    return current_job.get() is not None
+
+
+class Job:
+
+    def __init__(self, id_, line, context=None):
+        self.id = id_
+        self.line = line
+        self.context = context
+        self.state = 'queued'
+        self.status = None
+        self.progress = 0
+        self.started = None
+        self.finished = None
+        self.future = None
+        self._cancelled = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def done(self):
+        return self.state in ('done', 'failed', 'cancelled')
+
+    @property
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.monotonic()) - self.started
+
+    def checkpoint(self):
+        if self._cancelled.is_set():
+            raise JobCancelled(f"Job {self.id} cancelled")
+        with self._lock:
+            self.progress += 1
+
+    def cancel(self):
+        self._cancelled.set()
+        if self.future is not None and self.future.cancel():
+            self.state = 'cancelled'
+
+
+class JobManager:
+
+    workers = 4
+
+    def __init__(self, run):
+        self._run = run
+        self._jobs = {}
+        self._ids = itertools.count(1)
+        self._executor = None
+        self._lock = threading.Lock()
+        self._logger = logging.getLogger('app')
+
+    def submit(self, line, context=None):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='job')
+
+            job = Job(next(self._ids), line, context)
+            self._jobs[job.id] = job
+            job.future = self._executor.submit(self._execute, job)
+        return job
+
+    def _execute(self, job):
+        if job._cancelled.is_set():
+            job.state = 'cancelled'
+            return
+
+        job.state = 'running'
+        job.started = time.monotonic()
+        token = current_job.set(job)
+        try:
+            job.status = self._run(job.line, job.context)
+            job.state = 'done' if not job.status else 'failed'
+        except JobCancelled:
+            job.state = 'cancelled'
+            job.status = 1
+        except Exception as e:
+            self._logger.error(f"[{job.id}] {e}")
+            job.state = 'failed'
+            job.status = 1
+        finally:
+            current_job.reset(token)
+            job.finished = time.monotonic()
+            self._logger.info(f"[{job.id}] {job.state.capitalize()}: {job.line}")
+
+    def get(self, id_):
+        return self._jobs.get(id_)
+
+    def list(self):
+        return list(self._jobs.values())
+
+    def wait(self, jobs=None):
+        jobs = self.list() if jobs is None else jobs
+        wait([job.future for job in jobs if job.future is not None])
+        return jobs
+
+    def forget_finished(self):
+        with self._lock:
+            for id_ in [id_ for id_, job in self._jobs.items() if job.done]:
+                del self._jobs[id_]
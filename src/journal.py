@@ -0,0 +1,127 @@
+import json
+import logging
+import os
+import threading
+import time
+
+
+class TransferJournal:
+
+    # records are appended as JSON lines, fsync is batched and a lost tail only means redoing a few transfers
+    sync_every = 64
+    sync_interval = 1.0
+
+    def __init__(self, path):
+        self.path = path
+        self._states = {}
+        self._redo = set()
+        self._lock = threading.Lock()
+        self._logger = logging.getLogger('app')
+        self._read()
+
+        self._file = open(path, 'a')
+        self._unsynced = 0
+        if self._file.tell() and not self._ends_with_newline():
+            self._file.write('\n')  # keeps the next record off the torn line
+        self._synced_at = time.monotonic()
+
+    def _read(self):
+        try:
+            with open(self.path, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:  # torn write of the last record
+                        continue
+                    self._states[self._key(record['direction'], record['source'], record['destination'])] = record
+        except FileNotFoundError:
+            pass
+
+    def _ends_with_newline(self):
+        with open(self.path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b'\n'
+
+    @staticmethod
+    def _key(direction, source, destination):
+        return direction, source, destination
+
+    @staticmethod
+    def _stamp(direction, source):
+        # uploads of a source changed since its journal record are redone
+        if direction != 'upload':
+            return None
+        try:
+            stat = os.stat(source)
+        except OSError:
+            return None
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def plan(self, direction, pairs):
+        # yields the (source, destination) pairs left to transfer, the lock is not held while the caller transfers
+        done = 0
+        for source, destination in pairs:
+            stamp = self._stamp(direction, source)
+            with self._lock:
+                record = self._states.get(self._key(direction, source, destination))
+                if record and record['state'] == 'done' and record.get('stamp') == stamp:
+                    done += 1
+                    continue
+
+                if record is not None and (record['state'] in ('started', 'failed') or record.get('stamp') != stamp):
+                    self._redo.add(self._key(direction, source, destination))
+                if record is None or record.get('stamp') != stamp:
+                    self._write(direction, source, destination, 'planned', stamp)
+                    self._sync_if_due()
+            yield source, destination
+
+        with self._lock:
+            self._sync()
+        if done:
+            self._logger.info(f"{done} transfers already done according to {self.path} - Skipped")
+
+    def redo(self, direction, source, destination):
+        # left unfinished or with a changed source by an earlier run, the destination that exists is not trusted
+        return self._key(direction, source, destination) in self._redo
+
+    def start(self, direction, source, destination):
+        self._record(direction, source, destination, 'started')
+
+    def done(self, direction, source, destination):
+        self._record(direction, source, destination, 'done')
+
+    def fail(self, direction, source, destination):
+        self._record(direction, source, destination, 'failed')
+
+    def _record(self, direction, source, destination, state):
+        with self._lock:
+            self._write(direction, source, destination, state, self._stamp(direction, source))
+            self._sync_if_due()
+
+    def _sync_if_due(self):
+        if self._unsynced >= self.sync_every or time.monotonic() - self._synced_at >= self.sync_interval:
+            self._sync()
+
+    def _write(self, direction, source, destination, state, stamp):
+        record = {'direction': direction, 'source': source, 'destination': destination, 'state': state, 'stamp': stamp}
+        self._states[self._key(direction, source, destination)] = record
+        self._file.write(json.dumps(record) + '\n')
+        self._unsynced += 1
+
+    def _sync(self):
+        if self._unsynced:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._unsynced = 0
+        self._synced_at = time.monotonic()
+
+    def close(self):
+        with self._lock:
+            self._sync()
+            self._file.close()
@@ -1,21 +1,64 @@
+import atexit
 import logging
-from termcolor import colored
+import logging.handlers
+import queue
+import threading
+import time
+
+from src.lazy import LazyModule
+
+termcolor = LazyModule('termcolor')
 
 
 class Logger:
 
     def __init__(self):
         time_color = 'cyan'
-        formatter = self.ColoredFormatter(fmt=colored('%(asctime)s', time_color) + ' - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+        formatter = self.ColoredFormatter(fmt=termcolor.colored('%(asctime)s', time_color) + ' - %(colored_levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
         handler = logging.StreamHandler()
         handler.setFormatter(formatter)
+        self._summarizer = self.SummarizingHandler(handler)
+
+        # records are formatted and written by a listener thread, so a slow terminal does not block transfer loops
+        self._queue = queue.Queue()
+        self._listener = logging.handlers.QueueListener(self._queue, self._summarizer)
+        self._listener.start()
+        atexit.register(self.stop)
+
         self.logger = logging.getLogger('app')
         self.logger.setLevel(logging.DEBUG)
-        self.logger.addHandler(handler)
+        self._handler = self.QueueHandler(self._queue)
+        self.logger.addHandler(self._handler)
 
     def get(self):
         return self.logger
 
+    def stop(self):
+        # the handler is closed first, once the listener is stopped nothing reads a flush marker anymore
+        self.logger.removeHandler(self._handler)
+        self._handler.close()
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener = None
+        self._summarizer.flush()
+
+    class QueueHandler(logging.handlers.QueueHandler):
+        flush_timeout = 1.0
+        closed = False
+
+        def close(self):
+            self.closed = True
+            super().close()
+
+        def flush(self):
+            # waits until the listener has written the records queued so far, records that background jobs keep
+            # queueing after the marker are not waited for, and a busy listener holds the caller back a bounded time
+            if self.closed:
+                return
+            marker = logging.makeLogRecord({'flushed': threading.Event()})
+            self.queue.put_nowait(marker)
+            marker.flushed.wait(self.flush_timeout)
+
     class ColoredFormatter(logging.Formatter):
         LOG_COLORS = {
             'DEBUG': 'grey',
@@ -25,10 +68,74 @@ class Logger:
             'CRITICAL': 'red',
         }
 
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self._colored_levelnames = {levelname: termcolor.colored(levelname, color=level_color)
+                                        for levelname, level_color in self.LOG_COLORS.items()}
+
         def format(self, record):
             levelname = record.levelname
-            level_color = self.LOG_COLORS.get(levelname, 'white')
-            colored_levelname = colored(levelname, color=level_color)
-            record.levelname = colored_levelname
+            if levelname not in self._colored_levelnames:
+                self._colored_levelnames[levelname] = termcolor.colored(levelname, color='white')
+            record.colored_levelname = self._colored_levelnames[levelname]
 
             return super().format(record)
+
+    class SummarizingHandler(logging.Handler):
+        # per-file records (logged with an "event" extra) beyond `rate` per `interval` are counted and summarized
+        rate = 20
+        interval = 1.0
+
+        def __init__(self, handler):
+            super().__init__()
+            self._handler = handler
+            self._windows = {}
+            self._timer = None
+
+        def emit(self, record):
+            flushed = getattr(record, 'flushed', None)
+            if flushed is not None:
+                flushed.set()
+                return
+
+            event = getattr(record, 'event', None)
+            if event is None:
+                self._handler.handle(record)
+                return
+
+            now = time.monotonic()
+            window = self._windows.get(event)
+            if window is None or now - window['start'] >= self.interval:
+                self._summarize(event, window)
+                window = self._windows[event] = {'start': now, 'count': 0, 'suppressed': 0, 'record': record}
+
+            window['count'] += 1
+            if window['count'] <= self.rate:
+                self._handler.handle(record)
+                return
+
+            window['suppressed'] += 1
+            window['record'] = record
+            if self._timer is None:
+                self._timer = threading.Timer(self.interval, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+        def _summarize(self, event, window):
+            if not window or not window['suppressed']:
+                return
+
+            record = window['record']
+            summary = logging.makeLogRecord(record.__dict__)
+            summary.msg = f"... {window['suppressed']} more {event} messages, last one: {record.getMessage()}"
+            summary.args = None
+            self._handler.handle(summary)
+            window['suppressed'] = 0
+
+        def flush(self):
+            with self.lock:
+                self._timer = None
+                for event, window in list(self._windows.items()):
+                    self._summarize(event, window)
+                self._windows.clear()
+            self._handler.flush()
@@ -0,0 +1,32 @@
+import sys
+import time
+from contextlib import contextmanager
+
+
+class StartupProfile:
+
+    def __init__(self):
+        self._start = time.perf_counter()
+        self._phases = []
+
+    @property
+    def elapsed(self):
+        return (time.perf_counter() - self._start) * 1000
+
+    @contextmanager
+    def phase(self, name):
+        modules = set(sys.modules)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = (time.perf_counter() - start) * 1000
+            imported = sorted({module.split('.')[0] for module in set(sys.modules) - modules})
+            self._phases.append((name, duration, imported))
+
+    def report(self, file=None):
+        file = file or sys.stderr
+        print(f"{'phase':<12} | {'ms':>8} | imported", file=file)
+        for name, duration, imported in self._phases:
+            print(f"{name:<12} | {duration:>8.1f} | {', '.join(imported)}", file=file)
+        print(f"{'total':<12} | {self.elapsed:>8.1f} |", file=file)